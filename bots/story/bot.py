@@ -1,13 +1,20 @@
 import os
 import sys
 import json
+import time
 import spacy
 import random
+import signal
+import hashlib
 import datetime
+import threading
 import subprocess
 
 from ibots import utils
 from ibots.base import AbstractBasicBot
+from bots.story.gpt2 import worker as gpt2_worker
+from bots.story.gpt2 import encoder as gpt2_encoder
+from bots.story.gpt2 import memory as gpt2_memory
 
 DIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -15,6 +22,13 @@ nlp = spacy.load('en')
 
 TOP_K = 40
 
+# stop generating at the first sentence end past this fraction of text_length
+MIN_LENGTH_FRACTION = 0.75
+
+# share of context_length left after old entries are dropped from the context
+# with prefix_cache (see StoryBot.context_start)
+CONTEXT_KEEP_FRACTION = 0.5
+
 START_CONTEXT = 'Once upon a time,'
 
 INTRO_TITLE = 'One Thousand and One Bytes: Introduction'
@@ -75,6 +89,101 @@ Story Bot believes that good stories can bring people (and bots)
 together.'''
 
 
+class StoryIndex:
+    """
+    Local copy of every published page and entry, kept in sync with the page
+    scratches so that building the context or the table of contents takes
+    no API calls. Entries are dicts with page (number), entry (number), user,
+    text and token_count, in story order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as fd:
+                data = json.load(fd)
+            self.pages, self.entries = data['pages'], data['entries']
+        except (OSError, ValueError, KeyError):
+            self.pages, self.entries = [], []
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as fd:
+            json.dump({'pages': self.pages, 'entries': self.entries}, fd)
+        os.replace(self.path + '.tmp', self.path)
+
+    def complete(self, number):
+        """Whether all pages before page number are in the index"""
+        return len(self.pages) >= number - 1 and all(self.pages[:number - 1])
+
+    def sync(self, number, page_info, entries):
+        """Replace page number and its entries"""
+        self.pages.extend([None] * (number - len(self.pages)))
+        self.pages[number - 1] = page_info
+        self.entries = sorted(
+            [x for x in self.entries if x['page'] != number] + [
+                dict(x, page=number, entry=i) for i, x in enumerate(entries)
+            ],
+            key=lambda x: (x['page'], x['entry']),
+        )
+
+    def contributors(self):
+        """Users of the entries on each page, by page index"""
+        users = [[] for _ in self.pages]
+        for entry in self.entries:
+            users[entry['page'] - 1].append(entry['user'])
+        return users
+
+
+class ResultCache:
+    """
+    Generated texts on disk, one file per key, so that a restarted bot
+    reuses work done before it stopped. The least recently written files
+    are deleted once all of them take more than max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        try:
+            with open(self.path(key)) as fd:
+                value = json.load(fd)['text']
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, text):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(key) + '.tmp', 'w') as fd:
+            json.dump({'text': text}, fd)
+        os.replace(self.path(key) + '.tmp', self.path(key))
+
+        # evict the oldest results, but never the one just written
+        paths = sorted(
+            (x.path for x in os.scandir(self.directory)
+             if x.name.endswith('.json')),
+            key=os.path.getmtime,
+        )
+        total = sum(os.path.getsize(x) for x in paths)
+        for path in paths[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+
 class StoryBot(AbstractBasicBot):
     def run(
             self,
@@ -83,9 +192,43 @@ class StoryBot(AbstractBasicBot):
             context_length,
             text_length,
             page_length,
+            worker=False,
+            shared_worker=False,
+            backend='tf',
+            precision='float32',
+            prefix_cache=False,
+            candidates=1,
+            draft_model=None,
+            sliding_window=False,
+            time_budget=None,
+            pregenerate_minutes=60,
+            seed=None,
+            cache_bytes=2**20,
     ):
         self.model = model
         self.text_length = text_length
+        self.min_length = int(text_length * MIN_LENGTH_FRACTION)
+        self.worker = worker
+        self.shared_worker = shared_worker
+        self.backend = backend
+        self.precision = precision
+        self.prefix_cache = prefix_cache
+        self.candidates = candidates
+        self.draft_model = draft_model
+        self.sliding_window = sliding_window
+        self.time_budget = time_budget
+        self.encoder = gpt2_encoder.get_encoder(
+            model, os.path.join(DIR, 'gpt2', 'models'))
+        self.token_counts = {}
+        self.index = StoryIndex(
+            os.path.join(DIR, 'index', '{}.json'.format(self.id)))
+        self.pregenerate_minutes = pregenerate_minutes
+        self.pregeneration = None
+        self.seed = seed
+        self.results = ResultCache(os.path.join(DIR, 'cache'), cache_bytes)
+
+        if self.worker:
+            self.start_worker()
 
         # retrieve the table of contents activity or create new one
         try:
@@ -135,6 +278,9 @@ class StoryBot(AbstractBasicBot):
                 }))
             bootstrapping = True
 
+        if not self.index.complete(json.loads(page['scratch'])['number']):
+            self.rebuild_index()
+
         while True:
             now = utils.localtime()
             page, root, slots = self.initiate_page(
@@ -179,78 +325,21 @@ class StoryBot(AbstractBasicBot):
                         if bootstrapping:
                             context = START_CONTEXT
                         else:
-                            # construct context from previous entries
-                            context_list = []
-                            current_page = page
-                            current_scratch = json.loads(page['scratch'])
-                            entry_number = len(current_scratch['entries']) - 1
-
-                            while len(context_list) < context_length:
-                                if entry_number < 0:
-                                    current_page = self.activity_list(
-                                        user=self.id,
-                                        order_by='-created',
-                                        created_before=current_page['created'],
-                                        first=1,
-                                    )[0]
-
-                                    current_scratch = json.loads(
-                                        current_page['scratch'])
-                                    if not current_scratch['type'] == 'page':
-                                        self.logger.info('Incomplete context.')
-                                        break
-
-                                    entry_number = len(current_scratch) - 1
-
-                                context_list = list(
-                                    nlp(current_scratch['entries']
-                                        [entry_number]['text'] +
-                                        '\n\n')) + context_list
-
-                                entry_number -= 1
-
-                            context = ''.join(
-                                x.text_with_ws
-                                for x in context_list[len(context_list) -
-                                                      context_length:])
-
-                        self.logger.debug('Starting gpt2 generation')
-
-                        # call gpt2 using context and other parameters
-                        while True:
-                            try:
-                                gpt2_text = subprocess.check_output([
-                                    sys.executable,
-                                    os.path.join(
-                                        DIR,
-                                        'gpt2',
-                                        'generate_text.py',
-                                    ),
-                                    context,
-                                    '--length',
-                                    str(text_length),
-                                    '--top_k',
-                                    str(TOP_K),
-                                    '--model_name',
-                                    self.model,
-                                ]).decode('utf-8').replace(
-                                    '<|endoftext|>', ' ').strip()
-                                break
-                            except subprocess.CalledProcessError:
-                                self.logger.info(
-                                    'GPT-2 memory error; trying again with smaller context'
-                                )
-                                context = ' '.join(
-                                    context.split(' ')
-                                    [int(context.count(' ') / 4):])
-                                continue
-
-                        self.logger.debug('Done with gpt2 generation')
-
-                        # use spacy to trim off dangling sentence
-                        text = ''.join(
-                            x.text_with_ws
-                            for x in list(nlp(gpt2_text).sents)[:-1]).strip()
+                            context = self.build_context(
+                                context_length)
+
+                        if self.pregeneration and self.pregeneration.is_alive():
+                            self.logger.info(
+                                'Waiting for pre-generation to finish')
+                            self.pregeneration.join()
+                        gpt2_text = self.generate_cached(context)
+
+                        # use spacy to trim off dangling sentence, if any
+                        sents = list(nlp(gpt2_text).sents)
+                        if sents and not gpt2_encoder.SENTENCE_END.search(
+                                sents[-1].text):
+                            sents = sents[:-1]
+                        text = ''.join(x.text_with_ws for x in sents).strip()
 
                         if bootstrapping:
                             text = START_CONTEXT + ' ' + text
@@ -258,6 +347,7 @@ class StoryBot(AbstractBasicBot):
                     scratch['entries'].append({
                         'user': user,
                         'text': text,
+                        'token_count': len(self.encoder.encode(text + '\n\n')),
                     })
 
                     page = self.update_page(page, scratch)
@@ -265,7 +355,7 @@ class StoryBot(AbstractBasicBot):
                     if bootstrapping:
                         bootstrapping = False
 
-                intro = self.update_intro(intro, page)
+                intro = self.update_intro(intro)
 
                 # send out reward
                 if scratch['entries'][-1]['user'][
@@ -314,18 +404,356 @@ class StoryBot(AbstractBasicBot):
                         utils.localtime(),
                         page,
                     )
-                    intro = self.update_intro(intro, page)
+                    intro = self.update_intro(intro)
 
-            # wait until midnight
+            # wait until midnight, pre-generating the fallback entry in the
+            # last pregenerate_minutes before it
             now = utils.localtime()
-            self.api_wait(
-                timeout=((
-                    now.astimezone(datetime.timezone.utc) +
-                    datetime.timedelta(days=1)).astimezone(now.tzinfo).replace(
-                        hour=0,
-                        minute=0,
-                        second=0,
-                    ) - now).total_seconds())
+            timeout = ((now.astimezone(datetime.timezone.utc) +
+                        datetime.timedelta(days=1)).astimezone(
+                            now.tzinfo).replace(
+                                hour=0,
+                                minute=0,
+                                second=0,
+                            ) - now).total_seconds()
+            if timeout > self.pregenerate_minutes * 60:
+                timeout -= self.pregenerate_minutes * 60
+            elif not bootstrapping:
+                self.pregenerate(slots[-1], context_length)
+            self.api_wait(timeout=timeout)
+
+    def build_context(self, context_length):
+        """
+        The last context_length GPT-2 tokens of the story, or with
+        prefix_cache the last whole entries that fit, see context_start
+        """
+        entries = self.index.entries
+        if self.prefix_cache:
+            start = self.context_start(context_length)
+        else:
+            # newest to oldest until the entries reach context_length
+            start, total = len(entries), 0
+            while start > 0 and total < context_length:
+                start -= 1
+                total += entries[start]['token_count']
+
+        return self.encoder.decode(
+            self.encode_entries(start)[-context_length:])
+
+    def encode_entries(self, start):
+        """GPT-2 tokens of the entries from start on, joined as in the context"""
+        return self.encoder.encode(''.join(
+            entry['text'] + '\n\n' for entry in self.index.entries[start:]))
+
+    def context_start(self, context_length):
+        """
+        First entry of a context for the prefix cache. The context keeps
+        starting at the same entry while entries are added, and once it
+        outgrows context_length, old entries are dropped down to
+        CONTEXT_KEEP_FRACTION of it, so that consecutive contexts share
+        their beginning.
+        """
+        entries = self.index.entries
+        start = 0
+        total = 0
+        for i, entry in enumerate(entries):
+            # entries are joined by two '\n' tokens where alone they end
+            # with one '\n\n'
+            total += entry['token_count'] + 1
+            if total > context_length:
+                while start < i and (total >
+                                     context_length * CONTEXT_KEEP_FRACTION):
+                    total -= entries[start]['token_count'] + 1
+                    start += 1
+
+        # drop more entries if the estimate was short; the tokens of a
+        # single entry that doesn't fit on its own are cut
+        while start < len(entries) - 1 and len(
+                self.encode_entries(start)) > context_length:
+            start += 1
+        return start
+
+    def context_hash(self, context):
+        """Hash of a context and the settings that generation depends on"""
+        return hashlib.sha256(
+            json.dumps([
+                self.model,
+                self.text_length,
+                TOP_K,
+                self.seed,
+                self.candidates,
+                context,
+            ]).encode('utf-8')).hexdigest()
+
+    def generate_cached(self, context):
+        """Generate from context, reusing the result of an earlier run"""
+        key = self.context_hash(context)
+        gpt2_text = self.results.get(key)
+        self.logger.info('GPT-2 result cache {} ({} hits, {} misses)'.format(
+            'miss' if gpt2_text is None else 'hit',
+            self.results.hits,
+            self.results.misses,
+        ))
+        if gpt2_text is None:
+            gpt2_text = self.generate(context)
+            self.results.put(key, gpt2_text)
+        return gpt2_text
+
+    def pregenerate(self, slot, context_length):
+        """
+        Generate tomorrow's fallback entry into the result cache in the
+        background, unless it is there already or users submitted something
+        """
+        if self.pregeneration and self.pregeneration.is_alive():
+            return
+
+        context = self.build_context(context_length)
+        if self.context_hash(context) in self.results:
+            return
+
+        if any(x['user']['id'] != self.id
+               for x in self.comment_list(parent=slot['id'])):
+            return
+
+        self.logger.info('Pre-generating fallback entry')
+        self.pregeneration = threading.Thread(
+            target=self.generate_cached,
+            args=(context, ),
+            daemon=True,
+        )
+        self.pregeneration.start()
+
+    def rebuild_index(self):
+        """Sync every page into the index, with a single API call"""
+        self.logger.info('Rebuilding story index')
+        for page in self.activity_list(user=self.id, order_by='created'):
+            if json.loads(page['scratch'])['type'] == 'page':
+                self.sync_index(page)
+
+    def sync_index(self, page):
+        scratch = json.loads(page['scratch'])
+        self.index.sync(
+            scratch['number'],
+            {
+                'id': page['id'],
+                'link': self.get_app_link(page['id']),
+                'created': page['created'],
+            },
+            [{
+                'user': x['user'],
+                'text': x['text'],
+                'token_count': self.token_count(x),
+            } for x in scratch['entries']],
+        )
+        self.index.save()
+
+    def token_count(self, entry):
+        """Number of GPT-2 tokens of an entry in the context"""
+        if 'token_count' in entry:
+            return entry['token_count']
+
+        # entries from before token counts were stored
+        if entry['text'] not in self.token_counts:
+            self.token_counts[entry['text']] = len(
+                self.encoder.encode(entry['text'] + '\n\n'))
+        return self.token_counts[entry['text']]
+
+    def generator_options(self):
+        """Model options shared by the worker and generate_text.py"""
+        return {
+            'backend': self.backend,
+            'precision': self.precision,
+            'prefix_cache': self.prefix_cache,
+            'draft_model': self.draft_model,
+            # lets context_length + text_length exceed the model window
+            'sliding_window': self.sliding_window,
+            'seed': self.seed,
+        }
+
+    def generator_args(self):
+        """generator_options as command line arguments"""
+        args = ['--model_name', self.model]
+        for key, value in self.generator_options().items():
+            if value is True:
+                args.append('--' + key)
+            elif value is not None and value is not False:
+                args += ['--' + key, str(value)]
+        return args
+
+    def worker_differences(self):
+        """
+        generator_options that the running worker was started with
+        differently, as it applies its own to every request
+        """
+        options = gpt2_worker.stats(self.worker_path()).get('options', {})
+        return [
+            '{}={!r} instead of {!r}'.format(key, options.get(key), value)
+            for key, value in self.generator_options().items()
+            if options.get(key) != value
+        ]
+
+    def worker_path(self):
+        """
+        Socket of the worker of this model, or of the worker shared by all
+        stories of the host, which batches their requests together
+        """
+        if self.shared_worker:
+            return gpt2_worker.socket_path()
+        return gpt2_worker.socket_path(self.model)
+
+    def start_worker(self):
+        """Launch a generation worker for this model unless one is running"""
+        path = self.worker_path()
+        if gpt2_worker.is_running(path):
+            try:
+                differences = self.worker_differences()
+            except (OSError, RuntimeError) as e:
+                differences = [str(e)]
+            if differences:
+                self.logger.warning(
+                    'GPT-2 worker at {} runs with {}; restart it to use the '
+                    'settings of this story'.format(path,
+                                                    ', '.join(differences)))
+            return
+
+        self.logger.info('Starting gpt2 worker at {}'.format(path))
+        subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(DIR, 'gpt2', 'worker.py'),
+                '--path',
+                path,
+            ] + self.generator_args(),
+            start_new_session=True,
+        )
+
+    def generate(self, context):
+        self.logger.debug('Starting gpt2 generation')
+
+        # prefer the warm worker, if there is one
+        if self.worker:
+            try:
+                differences = self.worker_differences()
+                if not differences:
+                    return self.select(
+                        self.collect(
+                            gpt2_worker.stream(
+                                self.worker_path(),
+                                context,
+                                model_name=self.model,
+                                batch_size=self.candidates,
+                                length=self.text_length,
+                                top_k=TOP_K,
+                                stop_eos=True,
+                                stop_sentences=1,
+                                min_length=self.min_length,
+                            )))
+                # e.g. started by another story, or before a config change
+                self.logger.warning(
+                    'GPT-2 worker runs with {}; running subprocess'.format(
+                        ', '.join(differences)))
+            except (OSError, RuntimeError, MemoryError) as e:
+                self.logger.info(
+                    'GPT-2 worker unavailable ({}); running subprocess'.format(
+                        e))
+
+        # call gpt2 using context and other parameters. generate_text.py sizes
+        # the context to the memory it sees, so only a run that still ran out
+        # of memory (or was killed for it) is retried with less context
+        while True:
+            try:
+                candidates = self.collect(
+                    self.stream_subprocess([
+                        sys.executable,
+                        os.path.join(
+                            DIR,
+                            'gpt2',
+                            'generate_text.py',
+                        ),
+                        context,
+                        '--nsamples',
+                        str(self.candidates),
+                        '--batch_size',
+                        str(self.candidates),
+                        '--length',
+                        str(self.text_length),
+                        '--top_k',
+                        str(TOP_K),
+                        '--stop_eos',
+                        '--stop_sentences',
+                        '1',
+                        '--min_length',
+                        str(self.min_length),
+                        '--stream',
+                        '--json_output',
+                    ] + self.generator_args()))
+                break
+            except subprocess.CalledProcessError as e:
+                out_of_memory = e.returncode in [
+                    gpt2_memory.EXIT_OUT_OF_MEMORY,
+                    -signal.SIGKILL,
+                ]
+                if not out_of_memory or context.count(' ') < 4:
+                    self.logger.error(
+                        'GPT-2 generation failed with status {}'.format(
+                            e.returncode))
+                    raise
+                self.logger.info(
+                    'GPT-2 memory error; trying again with smaller context')
+                context = ' '.join(
+                    context.split(' ')[int(context.count(' ') / 4):])
+                continue
+
+        return self.select(candidates)
+
+    def stream_subprocess(self, args):
+        """Rows streamed by a generate_text.py run, which closing stops"""
+        process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        try:
+            for line in process.stdout:
+                yield json.loads(line.decode('utf-8'))
+            if process.wait():
+                raise subprocess.CalledProcessError(process.returncode, args)
+        finally:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+            process.stdout.close()
+
+    def collect(self, stream):
+        """
+        Candidates from the last rows of a stream, cutting it short once
+        time_budget seconds have passed
+        """
+        start = time.time()
+        rows = []
+        try:
+            for rows in stream:
+                if self.time_budget is not None and rows and (
+                        time.time() - start > self.time_budget) and not all(
+                            row['done'] for row in rows):
+                    self.logger.info(
+                        'GPT-2 time budget of {}s used up, stopping at {} '
+                        'characters'.format(
+                            self.time_budget,
+                            max(len(row['text']) for row in rows)))
+                    break
+        finally:
+            stream.close()
+        if not rows:
+            raise RuntimeError('GPT-2 returned no samples')
+        return [{'text': row['text'], 'score': row['score']} for row in rows]
+
+    def select(self, candidates):
+        """Pick the candidate with the highest mean token log-prob"""
+        candidates = sorted(candidates, key=lambda x: -x['score'])
+        self.logger.info('GPT-2 candidate scores: selected {:.3f}{}'.format(
+            candidates[0]['score'],
+            ''.join(', rejected {:.3f}'.format(x['score'])
+                    for x in candidates[1:]),
+        ))
+        self.logger.debug('Done with gpt2 generation')
+        return candidates[0]['text'].replace('<|endoftext|>', ' ').strip()
 
     def initiate_page(self, now, page, bootstrapping=False):
         scratch = json.loads(page['scratch'])
@@ -381,7 +809,7 @@ class StoryBot(AbstractBasicBot):
         elif scratch['next_link']:
             navigation += ' | [next]({})'.format(scratch['next_link'])
 
-        return self.activity_update(
+        page = self.activity_update(
             id=page['id'],
             title=PAGE_TITLE.format(scratch['number']),
             description=PAGE_DESCRIPTION.format(
@@ -397,19 +825,16 @@ class StoryBot(AbstractBasicBot):
             ),
             scratch=json.dumps(scratch),
         )
+        self.sync_index(page)
+        return page
 
-    def update_intro(self, intro, page):
-        scratch = json.loads(page['scratch'])
+    def update_intro(self, intro):
         intro_scratch = json.loads(intro['scratch'])
-        page_info = {
-            'link': self.get_app_link(page['id']),
-            'created': page['created'],
-            'contributors': [x['user'] for x in scratch['entries']],
-        }
-        if scratch['number'] > len(intro_scratch['pages']):
-            intro_scratch['pages'].append(page_info)
-        else:
-            intro_scratch['pages'][scratch['number'] - 1] = page_info
+        intro_scratch['pages'] = [{
+            'link': x['link'],
+            'created': x['created'],
+            'contributors': users,
+        } for x, users in zip(self.index.pages, self.index.contributors())]
         return self.activity_update(
             id=intro['id'],
             title=INTRO_TITLE,
@@ -0,0 +1,106 @@
+"""Time the BPE merge loop of encoder.py
+
+Encodes a corpus with Encoder.bpe and with the original implementation
+(reference_bpe, which rescans every pair after each merge), which
+test_encoder.py checks it against. Timings are taken with the word cache
+disabled so that every word goes through the merge loop.
+"""
+
+import os
+import time
+import fire
+import regex as re
+
+import encoder
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+CORPUS = os.path.join(DIR, 'bench_corpus.txt')
+
+
+def reference_bpe(bpe_ranks, token):
+    word = tuple(token)
+    pairs = encoder.get_pairs(word)
+
+    if not pairs:
+        return token
+
+    while True:
+        bigram = min(pairs, key=lambda pair: bpe_ranks.get(pair, float('inf')))
+        if bigram not in bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except ValueError:
+                new_word.extend(word[i:])
+                break
+
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        word = tuple(new_word)
+        if len(word) == 1:
+            break
+        else:
+            pairs = encoder.get_pairs(word)
+    return ' '.join(word)
+
+
+def bench_encoder(
+        *paths,
+        model_name='124M',
+        models_dir=os.path.join(DIR, 'models'),
+):
+    """
+    Time both merge loops on every word of the given text files
+    :paths : text files to use, defaults to bench_corpus.txt
+    :model_name=124M : String, whose vocabulary to use
+    :models_dir : path to parent folder containing model subfolders
+    """
+    models_dir = os.path.expanduser(os.path.expandvars(models_dir))
+    enc = encoder.get_encoder(model_name, models_dir)
+    words = []
+    for path in paths or [CORPUS]:
+        with open(path, encoding='utf-8') as f:
+            words.extend(''.join(enc.byte_encoder[b] for b in token.encode('utf-8'))
+                         for token in re.findall(enc.pat, f.read()))
+
+    print('{} words ({} distinct)'.format(len(words), len(set(words))))
+
+    start = time.time()
+    for word in words:
+        reference_bpe(enc.bpe_ranks, word)
+    before = time.time() - start
+
+    enc.cache_size = 0
+    start = time.time()
+    for word in words:
+        enc.bpe(word)
+    after = time.time() - start
+
+    enc.cache_size = 2**16
+    enc.cache.clear()
+    enc.cache_hits = enc.cache_misses = 0
+    start = time.time()
+    for word in words:
+        enc.bpe(word)
+    cached = time.time() - start
+
+    print('reference: {:.1f} us/word'.format(before / len(words) * 1e6))
+    print('heap:      {:.1f} us/word ({:.1f}x)'.format(
+        after / len(words) * 1e6, before / after))
+    print('cached:    {:.1f} us/word, {}'.format(cached / len(words) * 1e6,
+                                                enc.cache_info()))
+
+
+if __name__ == '__main__':
+    fire.Fire(bench_encoder)
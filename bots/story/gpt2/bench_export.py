@@ -0,0 +1,99 @@
+"""Measure the cold start of the tf backend with and without export.py
+
+Every run is a fresh process, like each generate_text.py call StoryBot
+makes: it imports TensorFlow, creates the generator and samples once with
+the settings of the first exported graph, then once more. With the export
+ignored, the graph is built in Python and the checkpoint restored into it;
+otherwise the SavedModel is loaded. The difference between the first and
+the second sample is the setup cost.
+"""
+
+import os
+import sys
+import json
+import fire
+import subprocess
+import statistics
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+CHILD = '''
+import json, time
+start = time.time()
+import generate_text
+generator = generate_text.get_generator(
+    'tf', model_name={model_name!r}, models_dir={models_dir!r})
+loaded = time.time()
+if not {exported!r}:
+    generator.exported = set()
+settings = {settings!r}
+times = [loaded]
+for _ in range(2):
+    generator.sample(
+        [0], settings['batch_size'], settings['length'],
+        settings['temperature'], settings['top_k'], settings['top_p'],
+        **generator.stop_conditions(settings['stop_eos'],
+                                    settings['stop_sentences'],
+                                    settings['min_length']))
+    times.append(time.time())
+print(json.dumps({{
+    'import': loaded - start,
+    'first_sample': times[1] - times[0],
+    'second_sample': times[2] - times[1],
+}}))
+'''
+
+
+def cold_start(model_name, models_dir, settings, exported):
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            '-c',
+            CHILD.format(
+                model_name=model_name,
+                models_dir=models_dir,
+                settings=settings,
+                exported=exported,
+            ),
+        ],
+        cwd=DIR,
+        stderr=subprocess.DEVNULL,
+    )
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def bench_export(
+        *model_names,
+        models_dir=os.path.join(DIR, 'models'),
+        runs=3,
+):
+    """
+    Print median seconds of each phase, with and without the exported
+    graphs of each model (run export.py first)
+    :model_names : models to measure, defaults to 124M
+    :models_dir : path to parent folder containing model subfolders
+    :runs=3 : Number of processes per variant
+    """
+    models_dir = os.path.expanduser(os.path.expandvars(models_dir))
+    print('| model | graph | import + init s | first sample s | '
+          'second sample s | setup s |')
+    print('|:-|:-|-:|-:|-:|-:|')
+    for model_name in model_names or ('124M', ):
+        with open(os.path.join(models_dir, model_name, 'saved_model',
+                               'samplers.json')) as f:
+            settings = json.load(f)['settings'][0]
+        for name, exported in [('built', False), ('exported', True)]:
+            times = [
+                cold_start(model_name, models_dir, settings, exported)
+                for _ in range(runs)
+            ]
+            before = statistics.median(x['import'] for x in times)
+            first = statistics.median(x['first_sample'] for x in times)
+            second = statistics.median(x['second_sample'] for x in times)
+            print('| {} | {} | {:.2f} | {:.2f} | {:.2f} | {:.2f} |'.format(
+                model_name, name, before, first, second,
+                before + first - second))
+
+
+if __name__ == '__main__':
+    fire.Fire(bench_export)
@@ -0,0 +1,101 @@
+"""Measure generation speed beyond the window of the model
+
+Generates length tokens, several times n_ctx, with the sliding window of
+np_sample.sample_sequence for a few window shifts, and with the naive
+alternative of running the last n_ctx - 1 tokens through the model for
+every token once the window is full. Greedy decoding keeps the runs
+comparable.
+"""
+
+import os
+import time
+import fire
+import numpy as np
+
+import np_model
+import np_sample
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+CORPUS = os.path.join(DIR, 'bench_corpus.txt')
+
+
+def naive_sequence(*, params, hparams, length, context):
+    """Greedy samples that always see the last n_ctx - 1 tokens"""
+    tokens = np.asarray(context, dtype=np.int32)
+    for _ in range(length):
+        logits = np_model.model(
+            params, hparams,
+            tokens[:, -(hparams.n_ctx - 1):])['logits'][:, -1, :hparams.n_vocab]
+        tokens = np.concatenate(
+            [tokens, logits.argmax(axis=-1)[:, np.newaxis]], axis=1)
+    return tokens
+
+
+def bench_long(
+        model_name='124M',
+        models_dir=os.path.join(DIR, 'models'),
+        precision='float32',
+        context_length=128,
+        length=None,
+        window_shifts=None,
+        retain_prefix=0,
+        naive=True,
+):
+    """
+    Print tokens per second for each window shift and the naive loop
+    :model_name=124M : String, which model to use
+    :models_dir : path to parent folder containing model subfolders
+    :precision=float32 : String, weight storage (see quantize.py)
+    :context_length=128 : Number of corpus tokens used as the prompt
+    :length=None : Number of tokens to generate, defaults to 2 * n_ctx
+    :window_shifts=None : Window shifts to compare, defaults to 1/8, 1/4 and
+     1/2 of n_ctx
+    :retain_prefix=0 : Integer, prompt tokens kept in view
+    :naive=True : Boolean, also time the naive loop, which is slow
+    """
+    models_dir = os.path.expanduser(os.path.expandvars(models_dir))
+    generator = np_sample.Generator(
+        model_name=model_name,
+        models_dir=models_dir,
+        precision=precision,
+    )
+    n_ctx = generator.hparams.n_ctx
+    if length is None:
+        length = 2 * n_ctx
+    if window_shifts is None:
+        window_shifts = (n_ctx // 8, n_ctx // 4, n_ctx // 2)
+    with open(CORPUS) as f:
+        context = [generator.enc.encode(f.read())[:context_length]]
+
+    print('{}: {} tokens after {} of context, n_ctx {}'.format(
+        model_name, length, len(context[0]), n_ctx))
+    print('| method | slides | tokens/s |')
+    print('|:-|-:|-:|')
+    for window_shift in window_shifts:
+        start = time.time()
+        out = np_sample.sample_sequence(
+            params=generator.params,
+            hparams=generator.hparams,
+            length=length,
+            context=context,
+            rng=np.random.RandomState(0),
+            top_k=1,
+            retain_prefix=retain_prefix,
+            window_shift=window_shift,
+        )
+        print('| window_shift={} | {} | {:.1f} |'.format(
+            window_shift, out['slides'], length / (time.time() - start)))
+    if naive:
+        start = time.time()
+        naive_sequence(
+            params=generator.params,
+            hparams=generator.hparams,
+            length=length,
+            context=context,
+        )
+        print('| naive | - | {:.1f} |'.format(length / (time.time() - start)))
+
+
+if __name__ == '__main__':
+    fire.Fire(bench_long)
@@ -0,0 +1,135 @@
+"""Calibrate the memory estimates of memory.py
+
+Every configuration runs in a fresh process. That process loads the model,
+generates one token from a one-token context so that the weights are paged
+in and the allocator is warm, and then generates from the configured
+context. The growth of the peak resident set size over the warm-up is the
+measured generation memory, and is compared with the growth memory.py
+predicts between the two runs. Ratios above 1 mean the estimate is safe.
+
+Real checkpoints are not needed: --make writes a model with random weights
+and any hyperparameters (see random_model.py), reusing the vocabulary of a
+downloaded model, e.g. a 124M-shaped model with
+
+    python bench_memory.py --make 124M-random --n_ctx 1024 --n_embd 768 \
+        --n_head 12 --n_layer 12
+"""
+
+import os
+import sys
+import json
+import fire
+import subprocess
+
+import random_model
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+CHILD = '''
+import json, resource
+import generate_text
+
+def peak():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+generator = generate_text.get_generator(
+    {backend!r},
+    model_name={model_name!r},
+    models_dir={models_dir!r},
+    memory_budget=2**62,
+)
+generator.sample([0], 1, 1, 1, 0, 1)
+baseline = peak()
+generator.sample([0] * {context_length}, {batch_size}, {length}, 1, 0, 1)
+measured = peak() - baseline
+generator.close()
+print(json.dumps({{
+    'measured': measured,
+    'estimate': generator.generation_bytes(
+        {batch_size}, {context_length}, {length}) -
+                generator.generation_bytes(1, 1, 1),
+}}))
+'''
+
+
+def measure(backend, model_name, models_dir, batch_size, context_length,
+            length):
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            '-c',
+            CHILD.format(
+                backend=backend,
+                model_name=model_name,
+                models_dir=models_dir,
+                batch_size=batch_size,
+                context_length=context_length,
+                length=length,
+            ),
+        ],
+        cwd=DIR,
+        stderr=subprocess.DEVNULL,
+    )
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def bench_memory(
+        *model_names,
+        models_dir=os.path.join(DIR, 'models'),
+        backend='numpy',
+        batch_sizes=(1, 4),
+        context_lengths=(64, 256, 512),
+        length=64,
+        make=None,
+        vocabulary='124M',
+        **hparams
+):
+    """
+    Print measured and estimated generation memory for each model, batch
+    size and context length
+    :model_names : models to measure, defaults to 124M
+    :models_dir : path to parent folder containing model subfolders
+    :backend=numpy : String, generation backend (see generate_text.py)
+    :batch_sizes=(1, 4) : Batch sizes to measure
+    :context_lengths=(64, 256, 512) : Context lengths to measure, skipped
+     where they don't fit the window next to length
+    :length=64 : Integer, number of tokens to generate
+    :make=None : String, if given, first write a random model of this name
+     (see random_model.py) and measure it
+    :vocabulary=124M : String, model whose vocabulary make uses
+    :hparams : n_ctx, n_embd, n_head and n_layer of the made model, by
+     default those of random_model.TINY
+    """
+    models_dir = os.path.expanduser(os.path.expandvars(models_dir))
+    if make:
+        random_model.write_model(
+            os.path.join(models_dir, make),
+            dict(random_model.TINY, **hparams),
+            vocabulary=os.path.join(models_dir, vocabulary),
+            checkpoint=backend == 'tf',
+        )
+        model_names += (make, )
+
+    print('| model | batch | context | measured MB | estimate MB | ratio |')
+    print('|:-|-:|-:|-:|-:|-:|')
+    for model_name in model_names or ('124M', ):
+        with open(os.path.join(models_dir, model_name, 'hparams.json')) as f:
+            n_ctx = json.load(f)['n_ctx']
+        for batch_size in batch_sizes:
+            for context_length in context_lengths:
+                if context_length + length > n_ctx:
+                    continue
+                result = measure(backend, model_name, models_dir, batch_size,
+                                 context_length, length)
+                print('| {} | {} | {} | {:.1f} | {:.1f} | {:.2f} |'.format(
+                    model_name,
+                    batch_size,
+                    context_length,
+                    result['measured'] / 2**20,
+                    result['estimate'] / 2**20,
+                    result['estimate'] / max(result['measured'], 1),
+                ))
+
+
+if __name__ == '__main__':
+    fire.Fire(bench_memory)
@@ -0,0 +1,122 @@
+"""Compare weight precisions of the numpy backend
+
+For every precision, a fresh process loads the model and reports the size
+of its weights, its peak RSS, decoding speed and perplexity on the fixed
+story corpus in bench_corpus.txt.
+"""
+
+import os
+import time
+import fire
+import resource
+import numpy as np
+import multiprocessing
+
+import np_model
+import np_sample
+import quantize
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+CORPUS = os.path.join(DIR, 'bench_corpus.txt')
+
+
+def perplexity(params, hparams, tokens, window=256):
+    """Perplexity of tokens, scored in non-overlapping windows"""
+    nll = []
+    for i in range(0, len(tokens) - 1, window):
+        chunk = np.asarray(tokens[i:i + window + 1], dtype=np.int32)
+        if len(chunk) < 2:
+            break
+        logits = np_model.model(params, hparams, chunk[np.newaxis, :-1])
+        logits = logits['logits'][0].astype(np.float64)
+        logits -= logits.max(axis=-1, keepdims=True)
+        log_probs = logits - np.log(np.exp(logits).sum(axis=-1,
+                                                       keepdims=True))
+        nll.extend(-log_probs[np.arange(len(chunk) - 1), chunk[1:]])
+    return float(np.exp(np.mean(nll)))
+
+
+def measure(model_name, models_dir, precision, context_length, length):
+    start = time.time()
+    generator = np_sample.Generator(
+        model_name=model_name,
+        models_dir=models_dir,
+        precision=precision,
+    )
+    load_time = time.time() - start
+    params, hparams = generator.params, generator.hparams
+
+    with open(CORPUS) as f:
+        tokens = generator.enc.encode(f.read())
+
+    start = time.time()
+    np_sample.sample_sequence(
+        params=params,
+        hparams=hparams,
+        length=length,
+        context=[tokens[:context_length]],
+        rng=np.random.RandomState(0),
+        top_k=40,
+    )
+    tokens_per_sec = length / (time.time() - start)
+
+    return {
+        'precision': precision,
+        'weight_mb': sum(x.nbytes for x in params.values()) / 2**20,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+        2**10,
+        'load_sec': load_time,
+        'tokens_per_sec': tokens_per_sec,
+        'perplexity': perplexity(params, hparams, tokens),
+    }
+
+
+def bench_quantize(
+        model_name='124M',
+        models_dir=os.path.join(DIR, 'models'),
+        context_length=128,
+        length=32,
+):
+    """
+    Print a table of memory, speed and perplexity for each precision
+    :model_name=124M : String, which model to use
+    :models_dir : path to parent folder containing model subfolders
+    :context_length=128 : Number of corpus tokens used as the prompt
+    :length=32 : Number of tokens to generate for the speed measurement
+    """
+    models_dir = os.path.expanduser(os.path.expandvars(models_dir))
+    rows = []
+    for precision in quantize.PRECISIONS:
+        # a fresh process per precision keeps the peak RSS numbers separate
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            rows.append(
+                pool.apply(measure, (
+                    model_name,
+                    models_dir,
+                    precision,
+                    context_length,
+                    length,
+                )))
+
+    base = rows[0]
+    print('| precision | weights MB | peak RSS MB | load s | tokens/s | '
+          'perplexity |')
+    print('|:-|-:|-:|-:|-:|-:|')
+    for row in rows:
+        print('| {} | {:.1f} ({:+.0%}) | {:.1f} | {:.2f} | {:.2f} ({:+.0%}) | '
+              '{:.3f} ({:+.2%}) |'.format(
+                  row['precision'],
+                  row['weight_mb'],
+                  row['weight_mb'] / base['weight_mb'] - 1,
+                  row['peak_rss_mb'],
+                  row['load_sec'],
+                  row['tokens_per_sec'],
+                  row['tokens_per_sec'] / base['tokens_per_sec'] - 1,
+                  row['perplexity'],
+                  row['perplexity'] / base['perplexity'] - 1,
+              ))
+
+
+if __name__ == '__main__':
+    fire.Fire(bench_quantize)
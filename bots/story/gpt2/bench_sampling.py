@@ -0,0 +1,89 @@
+"""Time one sampling step on random logits
+
+Compares the original pipeline (top_k_logits, then top_p_logits over the
+whole vocabulary, then a multinomial draw) with the fused sample_logits.
+"""
+
+import os
+import time
+import fire
+import logging
+import warnings
+import numpy as np
+
+N_VOCAB = 50257
+
+
+def time_per_call(fn, iterations):
+    fn()  # warm up
+    start = time.time()
+    for _ in range(iterations):
+        fn()
+    return (time.time() - start) / iterations
+
+
+def bench_numpy(logits, top_k, top_p, iterations):
+    import np_sample
+
+    rng = np.random.RandomState(0)
+
+    def before():
+        filtered = np_sample.top_k_logits(logits, k=top_k)
+        filtered = np_sample.top_p_logits(filtered, p=top_p)
+        return np_sample.multinomial(filtered, rng)
+
+    def after():
+        return np_sample.sample_logits(logits, rng, top_k=top_k, top_p=top_p)
+
+    return time_per_call(before, iterations), time_per_call(after, iterations)
+
+
+def bench_tf(logits, top_k, top_p, iterations):
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=FutureWarning)
+        import tensorflow as tf
+        import sample
+    tf.get_logger().setLevel(logging.ERROR)
+
+    with tf.Session(graph=tf.Graph()) as sess:
+        placeholder = tf.placeholder(tf.float32, logits.shape)
+        filtered = sample.top_k_logits(placeholder, k=top_k)
+        filtered = sample.top_p_logits(filtered, p=top_p)
+        before = tf.multinomial(filtered, num_samples=1, output_dtype=tf.int32)
+        after = sample.sample_logits(placeholder, top_k=top_k, top_p=top_p)
+        return tuple(
+            time_per_call(lambda: sess.run(x, {placeholder: logits}),
+                          iterations) for x in [before, after])
+
+
+def bench_sampling(
+        backend='numpy',
+        top_k=40,
+        top_p=1,
+        batch_size=1,
+        iterations=200,
+):
+    """
+    Print the time per decoding step spent on sampling
+    :backend=numpy : String, numpy or tf
+    :top_k=40 : Integer, as passed by StoryBot
+    :top_p=1 : Float, nucleus cutoff
+    :batch_size=1 : Integer, rows of logits per step
+    :iterations=200 : Integer, steps to average over
+    """
+    logits = np.random.RandomState(0).randn(
+        batch_size, N_VOCAB).astype(np.float32) * 3
+    before, after = {
+        'numpy': bench_numpy,
+        'tf': bench_tf,
+    }[backend](logits, top_k, top_p, iterations)
+    print('{} top_k={} top_p={} batch_size={}'.format(
+        backend, top_k, top_p, batch_size))
+    print('before: {:.3f} ms/step'.format(before * 1000))
+    print('after:  {:.3f} ms/step ({:.1f}x)'.format(after * 1000,
+                                                    before / after))
+
+
+if __name__ == '__main__':
+    fire.Fire(bench_sampling)
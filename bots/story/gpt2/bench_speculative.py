@@ -0,0 +1,96 @@
+"""Measure speculative decoding against plain sampling of the target model
+
+For every draft length, reports the fraction of drafted tokens the target
+model accepted and the decoding speed relative to sampling the target
+alone, with a prompt from the fixed story corpus in bench_corpus.txt.
+"""
+
+import os
+import time
+import fire
+import numpy as np
+
+import np_sample
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+CORPUS = os.path.join(DIR, 'bench_corpus.txt')
+
+
+def bench_speculative(
+        model_name='355M',
+        draft_model='124M',
+        models_dir=os.path.join(DIR, 'models'),
+        precision='float32',
+        draft_lengths=(2, 3, 4, 6),
+        context_length=128,
+        length=64,
+        top_k=40,
+        trials=3,
+):
+    """
+    Print a table of acceptance rate and speedup per draft length
+    :model_name=355M : String, target model
+    :draft_model=124M : String, model drafting the tokens
+    :models_dir : path to parent folder containing model subfolders
+    :precision=float32 : String, weight storage of both models
+    :draft_lengths=(2, 3, 4, 6) : Tokens drafted per round to compare
+    :context_length=128 : Number of corpus tokens used as the prompt
+    :length=64 : Number of tokens to generate per trial
+    :top_k=40 : Integer, as passed by StoryBot
+    :trials=3 : Number of generations to average over
+    """
+    models_dir = os.path.expanduser(os.path.expandvars(models_dir))
+    generator = np_sample.Generator(
+        model_name=model_name,
+        models_dir=models_dir,
+        precision=precision,
+        draft_model=draft_model,
+    )
+    with open(CORPUS) as f:
+        context = [generator.enc.encode(f.read())[:context_length]]
+
+    def run(sequence, **kwargs):
+        start = time.time()
+        out = sequence(
+            params=generator.params,
+            hparams=generator.hparams,
+            length=length,
+            context=context,
+            rng=np.random.RandomState(0),
+            top_k=top_k,
+            **kwargs,
+        )
+        return time.time() - start, out
+
+    run(np_sample.sample_sequence)  # warm up
+    base = sum(run(np_sample.sample_sequence)[0]
+               for _ in range(trials)) / trials
+
+    print('{} drafted by {}, top_k={}, {} tokens after {}'.format(
+        model_name, draft_model, top_k, length, context_length))
+    print('| draft length | acceptance | tokens/s | speedup |')
+    print('|-:|-:|-:|-:|')
+    print('| - | - | {:.2f} | 1.00x |'.format(length / base))
+    for draft_length in draft_lengths:
+        elapsed = proposed = accepted = 0
+        for _ in range(trials):
+            seconds, out = run(
+                np_sample.speculative_sequence,
+                draft_params=generator.draft_params,
+                draft_hparams=generator.draft_hparams,
+                draft_length=draft_length,
+            )
+            elapsed += seconds / trials
+            proposed += out['proposed']
+            accepted += out['accepted']
+        print('| {} | {:.1%} | {:.2f} | {:.2f}x |'.format(
+            draft_length,
+            accepted / max(proposed, 1),
+            length / elapsed,
+            base / elapsed,
+        ))
+
+
+if __name__ == '__main__':
+    fire.Fire(bench_speculative)
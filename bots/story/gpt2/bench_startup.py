@@ -0,0 +1,75 @@
+"""Time loading the encoder in a fresh process
+
+Compares parsing encoder.json and vocab.bpe with reading the compiled
+encoder.bin (see encoder.write_compiled), the way every generate_text.py
+run started by StoryBot pays for it.
+"""
+
+import os
+import sys
+import time
+import fire
+import subprocess
+import statistics
+
+import encoder
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+CHILD = '''
+import sys, time
+start = time.time()
+import encoder
+encoder.get_encoder({model_name!r}, {models_dir!r}, compiled={compiled!r})
+print(time.time() - start)
+'''
+
+
+def load_time(model_name, models_dir, compiled):
+    """Seconds spent importing and loading the encoder, and in the process"""
+    start = time.time()
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            '-c',
+            CHILD.format(
+                model_name=model_name,
+                models_dir=models_dir,
+                compiled=compiled,
+            ),
+        ],
+        cwd=DIR,
+    )
+    return float(output), time.time() - start
+
+
+def bench_startup(
+        model_name='124M',
+        models_dir=os.path.join(DIR, 'models'),
+        runs=10,
+):
+    """
+    Print median encoder load and process times with and without encoder.bin
+    :model_name=124M : String, whose vocabulary to load
+    :models_dir : path to parent folder containing model subfolders
+    :runs=10 : Number of processes per variant
+    """
+    models_dir = os.path.expanduser(os.path.expandvars(models_dir))
+    # make sure the compiled file exists and is current
+    encoder.get_encoder(model_name, models_dir)
+
+    print('| encoder | load ms | process ms |')
+    print('|:-|-:|-:|')
+    for name, compiled in [('json/bpe', False), ('encoder.bin', True)]:
+        times = [
+            load_time(model_name, models_dir, compiled) for _ in range(runs)
+        ]
+        print('| {} | {:.1f} | {:.1f} |'.format(
+            name,
+            statistics.median(x for x, _ in times) * 1000,
+            statistics.median(x for _, x in times) * 1000,
+        ))
+
+
+if __name__ == '__main__':
+    fire.Fire(bench_startup)
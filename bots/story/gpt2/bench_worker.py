@@ -0,0 +1,192 @@
+"""Load test of workers serving several StoryBots at once
+
+Simulates bots that all send a request with a different story at the same
+moment, like StoryBots at midnight, and compares three setups:
+
+- separate: one worker process per bot, each with its own copy of the model
+- serial: one shared worker that decodes one request after the other
+- batched: one shared worker that decodes them together in a padded batch
+
+For each it reports the seconds until the last bot has its candidates, the
+CPU seconds the workers spent on the requests and the memory of the worker
+processes: the sum of their peak resident set sizes and, as weights memory
+mapped by several processes are shared, of their proportional set sizes
+after the requests. Without the given model, a tiny model with random
+weights is used (see random_model.py).
+"""
+
+import os
+import sys
+import time
+import fire
+import shutil
+import tempfile
+import threading
+import subprocess
+
+import worker
+import random_model
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+CORPUS = os.path.join(DIR, 'bench_corpus.txt')
+
+
+def proc_status(pid, key, name='status'):
+    """Value in kB of key in /proc/<pid>/status (or smaps_rollup)"""
+    with open('/proc/{}/{}'.format(pid, name)) as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def cpu_seconds(pid):
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def start_workers(workers, count, model_name, models_dir, tmp_dir, **options):
+    """Start count more (path, process) workers and wait until they listen"""
+    for i in range(count):
+        path = os.path.join(tmp_dir, 'worker{}.sock'.format(i))
+        args = [
+            sys.executable,
+            os.path.join(DIR, 'worker.py'),
+            '--model_name',
+            model_name,
+            '--models_dir',
+            models_dir,
+            '--path',
+            path,
+            '--seed',
+            '0',
+        ]
+        for key, value in options.items():
+            args += ['--' + key, str(value)]
+        workers.append((path,
+                        subprocess.Popen(args,
+                                         cwd=DIR,
+                                         stderr=subprocess.DEVNULL)))
+    for path, process in workers:
+        while not worker.is_running(path):
+            if process.poll() is not None:
+                raise RuntimeError('Worker exited with status {}'.format(
+                    process.returncode))
+            time.sleep(0.1)
+
+
+def load_test(paths, processes, prompts, **kwargs):
+    """Send one request per prompt at once, the i-th to paths[i]"""
+    errors = []
+
+    def bot(path, prompt):
+        try:
+            worker.request(path, prompt, **kwargs)
+        except Exception as e:
+            errors.append(e)
+
+    cpu = sum(cpu_seconds(p.pid) for p in processes)
+    start = time.time()
+    threads = [
+        threading.Thread(target=bot, args=(path, prompt))
+        for path, prompt in zip(paths, prompts)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return {
+        'wall': time.time() - start,
+        'cpu': sum(cpu_seconds(p.pid) for p in processes) - cpu,
+        'peak_rss': sum(proc_status(p.pid, 'VmHWM') for p in processes) *
+        1024,
+        'pss': sum(proc_status(p.pid, 'Pss', 'smaps_rollup')
+                   for p in processes) * 1024,
+    }
+
+
+def bench_worker(
+        model_name='124M',
+        models_dir=os.path.join(DIR, 'models'),
+        bots=(1, 2, 4),
+        backend='numpy',
+        precision='float32',
+        context_words=150,
+        length=64,
+        candidates=4,
+        batch_wait=1,
+):
+    """
+    Print the table of the load test for each number of bots
+    :model_name=124M : String, model to serve, a tiny random model if it
+     isn't in models_dir
+    :models_dir : path to parent folder containing model subfolders
+    :bots=(1, 2, 4) : Numbers of concurrent bots to simulate
+    :backend=numpy : String, generation backend (tf can't batch)
+    :precision=float32 : String, weight precision for the numpy backend
+    :context_words=150 : Integer, words of the story each bot sends
+    :length=64 : Integer, tokens generated per candidate
+    :candidates=4 : Integer, candidates each bot asks for
+    :batch_wait=1 : Float, seconds the batched worker waits for requests
+    """
+    models_dir = os.path.expanduser(os.path.expandvars(models_dir))
+    tmp_dir = tempfile.mkdtemp()
+    if not os.path.exists(os.path.join(models_dir, model_name,
+                                       'hparams.json')):
+        models_dir, model_name = tmp_dir, 'random-tiny'
+        random_model.write_model(os.path.join(models_dir, model_name))
+
+    with open(CORPUS) as f:
+        words = f.read().split()
+    options = dict(backend=backend, precision=precision)
+    kwargs = dict(length=length, batch_size=candidates, top_k=40)
+
+    print('| bots | setup | seconds | CPU s | peak RSS MB | PSS MB |')
+    print('|-:|:-|-:|-:|-:|-:|')
+    try:
+        for n in bots:
+            # a different story per bot
+            prompts = [
+                ' '.join(words[i * 37:i * 37 + context_words])
+                for i in range(n)
+            ]
+            for setup in ['separate', 'serial', 'batched']:
+                workers = []
+                try:
+                    start_workers(
+                        workers,
+                        n if setup == 'separate' else 1,
+                        model_name,
+                        models_dir,
+                        tmp_dir,
+                        batch_wait=batch_wait if setup == 'batched' else 0,
+                        max_batch=n * candidates if setup == 'batched' else 1,
+                        **options,
+                    )
+                    paths = [path for path, _ in workers]
+                    result = load_test(
+                        [paths[i % len(paths)] for i in range(n)],
+                        [process for _, process in workers], prompts,
+                        **kwargs)
+                except Exception as e:
+                    # e.g. a worker killed for running out of memory
+                    print('| {} | {} | {}: {} |'.format(
+                        n, setup, type(e).__name__, e))
+                    continue
+                finally:
+                    for _, process in workers:
+                        process.terminate()
+                        process.wait()
+                print('| {} | {} | {:.2f} | {:.2f} | {:.0f} | {:.0f} |'.format(
+                    n, setup, result['wall'], result['cpu'],
+                    result['peak_rss'] / 2**20, result['pss'] / 2**20))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    fire.Fire(bench_worker)
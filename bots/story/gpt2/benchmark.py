@@ -0,0 +1,267 @@
+"""Benchmark generation across models, backends and sizes
+
+Runs a fixed prompt from bench_corpus.txt with a fixed seed through every
+installed model and backend, for each combination of context length, text
+length and batch size. Each combination runs in a fresh process, which
+reports:
+
+- cold_start: seconds from starting the process to the end of the first
+  generation, including imports, loading weights and building graphs
+- prefill: median seconds until the first token of later generations
+- decode_p50 and decode_p99: per-token decode latency in seconds. The
+  numpy backend times every step. The tf loop runs inside the graph, so
+  there each generation contributes its mean time per token instead
+  (decode_timing says which)
+- tokens_per_second: generated tokens of all rows per second
+- peak_rss: peak resident set size of the process in bytes
+
+Results are written as JSON together with the machine and commit, so runs
+can be compared across changes. Without any downloaded model, a tiny model
+with random weights and a byte vocabulary is benchmarked instead (see
+random_model.py), which needs no network.
+"""
+
+import os
+import sys
+import json
+import time
+import fire
+import shutil
+import platform
+import tempfile
+import importlib.util
+import subprocess
+import numpy as np
+
+import random_model
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+CORPUS = os.path.join(DIR, 'bench_corpus.txt')
+
+CHILD = '''
+import time
+import json, resource
+import numpy as np
+import np_model
+import generate_text
+
+settings = {settings!r}
+generator = generate_text.get_generator(
+    settings['backend'],
+    model_name=settings['model'],
+    models_dir={models_dir!r},
+    seed=settings['seed'],
+    memory_budget=2**62,
+)
+with open({corpus!r}) as f:
+    prompt = generator.enc.encode(f.read())
+context = (prompt * (settings['context_length'] // len(prompt) + 1))[:settings['context_length']]
+
+# start time of every model call of the numpy backend
+steps = []
+model = np_model.model
+def timed_model(*args, **kwargs):
+    steps.append(time.time())
+    return model(*args, **kwargs)
+np_model.model = timed_model
+
+def generate(length):
+    del steps[:]
+    begin = time.time()
+    generator.sample(context, settings['batch_size'], length, 1, 0, 1)
+    return begin, time.time()
+
+generate(settings['text_length'])
+cold_start = time.time() - {spawned!r}
+if settings['backend'] == 'tf':
+    generate(1)
+
+prefill, decode, rates = [], [], []
+for _ in range({runs}):
+    if settings['backend'] == 'tf':
+        begin, end = generate(1)
+        prefill.append(end - begin)
+    begin, end = generate(settings['text_length'])
+    rates.append(settings['batch_size'] * settings['text_length'] / (end - begin))
+    if steps:
+        prefill.append(steps[1] - steps[0] if len(steps) > 1 else end - steps[0])
+        decode.extend(np.diff(steps[1:] + [end]).tolist())
+    elif settings['text_length'] > 1:
+        decode.append((end - begin - np.median(prefill)) / (settings['text_length'] - 1))
+generator.close()
+
+print(json.dumps(dict(
+    settings,
+    cold_start=cold_start,
+    prefill=float(np.median(prefill)),
+    decode_p50=float(np.percentile(decode, 50)) if decode else None,
+    decode_p99=float(np.percentile(decode, 99)) if decode else None,
+    decode_timing='step' if steps else 'mean',
+    tokens_per_second=float(np.median(rates)),
+    peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+)))
+'''
+
+
+def installed_models(models_dir):
+    """Names of the models in models_dir with their hyperparameters"""
+    if not os.path.isdir(models_dir):
+        return []
+    return sorted(
+        name for name in os.listdir(models_dir)
+        if os.path.exists(os.path.join(models_dir, name, 'hparams.json')))
+
+
+def available_backends(model_dir):
+    """Backends that can load the model in model_dir"""
+    found = []
+    has_checkpoint = os.path.exists(os.path.join(model_dir, 'checkpoint'))
+    if has_checkpoint or os.path.exists(
+            os.path.join(model_dir, 'weights.json')):
+        found.append('numpy')
+    if has_checkpoint and importlib.util.find_spec('tensorflow'):
+        found.append('tf')
+    return found
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=DIR,
+            stderr=subprocess.DEVNULL,
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(settings, models_dir, runs):
+    """Benchmark one combination in a fresh process"""
+    process = subprocess.run(
+        [
+            sys.executable,
+            '-c',
+            CHILD.format(
+                settings=settings,
+                models_dir=models_dir,
+                corpus=CORPUS,
+                runs=runs,
+                spawned=time.time(),
+            ),
+        ],
+        cwd=DIR,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if process.returncode:
+        return dict(settings,
+                    error=process.stderr.decode('utf-8').strip().split('\n')[-1])
+    return json.loads(process.stdout.decode('utf-8').splitlines()[-1])
+
+
+def benchmark(
+        *model_names,
+        models_dir=os.path.join(DIR, 'models'),
+        backends=None,
+        context_lengths=(64, 256),
+        text_lengths=(32, 128),
+        batch_sizes=(1, 4),
+        runs=3,
+        seed=0,
+        output='benchmark.json',
+):
+    """
+    Benchmark every combination and write the results to output
+    :model_names : models to benchmark, defaults to all in models_dir, or a
+     tiny random model if there are none
+    :models_dir : path to parent folder containing model subfolders
+    :backends=None : Backends to benchmark, defaults to all that can load
+     each model (tf needs TensorFlow and a checkpoint)
+    :context_lengths=(64, 256) : Prompt lengths in tokens
+    :text_lengths=(32, 128) : Generated tokens per row
+    :batch_sizes=(1, 4) : Rows generated together
+    :runs=3 : Generations per combination after the first
+    :seed=0 : Integer seed for the sampling
+    :output=benchmark.json : Path of the JSON results
+    """
+    models_dir = os.path.expanduser(os.path.expandvars(models_dir))
+    tmp_dir = None
+    if not model_names:
+        model_names = installed_models(models_dir)
+    if not model_names:
+        tmp_dir = models_dir = tempfile.mkdtemp()
+        model_names = ['random-tiny']
+        random_model.write_model(
+            os.path.join(models_dir, 'random-tiny'),
+            checkpoint=bool(importlib.util.find_spec('tensorflow')),
+        )
+
+    results = []
+    print('| model | backend | batch | context | text | cold start s | '
+          'prefill ms | decode p50 ms | decode p99 ms | tokens/s | '
+          'peak RSS MB |')
+    print('|:-|:-|-:|-:|-:|-:|-:|-:|-:|-:|-:|')
+    try:
+        for model_name in model_names:
+            model_dir = os.path.join(models_dir, model_name)
+            with open(os.path.join(model_dir, 'hparams.json')) as f:
+                n_ctx = json.load(f)['n_ctx']
+            for backend in backends or available_backends(model_dir):
+                for batch_size in batch_sizes:
+                    for context_length in context_lengths:
+                        for text_length in text_lengths:
+                            if context_length + text_length > n_ctx:
+                                continue
+                            result = run(
+                                dict(
+                                    model=model_name,
+                                    backend=backend,
+                                    batch_size=batch_size,
+                                    context_length=context_length,
+                                    text_length=text_length,
+                                    seed=seed,
+                                ), models_dir, runs)
+                            results.append(result)
+                            if 'error' in result:
+                                print('| {model} | {backend} | {batch_size} | '
+                                      '{context_length} | {text_length} | '
+                                      '{error} |'.format(**result))
+                                continue
+                            print('| {} | {} | {} | {} | {} | {:.2f} | {:.1f} | '
+                                  '{} | {} | {:.1f} | {:.0f} |'.format(
+                                      model_name, backend, batch_size,
+                                      context_length, text_length,
+                                      result['cold_start'],
+                                      result['prefill'] * 1000,
+                                      *('-' if x is None else '{:.2f}'.format(
+                                          x * 1000) for x in [
+                                              result['decode_p50'],
+                                              result['decode_p99']
+                                          ]),
+                                      result['tokens_per_second'],
+                                      result['peak_rss'] / 2**20))
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    with open(output, 'w') as f:
+        json.dump({
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': commit(),
+            'machine': {
+                'platform': platform.platform(),
+                'processor': platform.processor(),
+                'cpus': os.cpu_count(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+            },
+            'runs': runs,
+            'results': results,
+        }, f, indent=2)
+    print('Wrote {} results to {}'.format(len(results), output),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    fire.Fire(benchmark)
@@ -0,0 +1,155 @@
+"""Read TensorFlow checkpoints without TensorFlow
+
+A checkpoint written by tf.train.Saver is a "tensor bundle": an index file
+in LevelDB table format mapping variable names to BundleEntryProto
+messages, plus data files holding the raw little-endian tensor bytes. Only
+the small subset of both formats used by the GPT-2 checkpoints is parsed.
+"""
+
+import os
+import struct
+import numpy as np
+
+TABLE_MAGIC = 0xdb4775248b80fb57
+
+# tensorflow DataType enum values
+DTYPES = {
+    1: np.float32,
+    2: np.float64,
+    3: np.int32,
+    9: np.int64,
+    19: np.float16,
+}
+
+
+def read_varint(data, i):
+    result = shift = 0
+    while True:
+        byte = data[i]
+        i += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return result, i
+
+
+def read_proto(data):
+    """Decode a protobuf message into a list of (field, value) pairs"""
+    fields = []
+    i = 0
+    while i < len(data):
+        key, i = read_varint(data, i)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, i = read_varint(data, i)
+        elif wire_type == 1:
+            value = data[i:i + 8]
+            i += 8
+        elif wire_type == 2:
+            size, i = read_varint(data, i)
+            value = data[i:i + size]
+            i += size
+        elif wire_type == 5:
+            value = data[i:i + 4]
+            i += 4
+        else:
+            raise ValueError('Unsupported wire type {}'.format(wire_type))
+        fields.append((field, value))
+    return fields
+
+
+def read_block(data, offset, size):
+    """Yield the (key, value) pairs of one table block"""
+    if data[offset + size] != 0:
+        raise ValueError('Compressed checkpoint index blocks are unsupported')
+    block = data[offset:offset + size]
+    num_restarts, = struct.unpack('<I', block[-4:])
+    end = len(block) - 4 * (num_restarts + 1)
+
+    key = b''
+    i = 0
+    while i < end:
+        shared, i = read_varint(block, i)
+        non_shared, i = read_varint(block, i)
+        value_size, i = read_varint(block, i)
+        key = key[:shared] + block[i:i + non_shared]
+        i += non_shared
+        yield key, block[i:i + value_size]
+        i += value_size
+
+
+def read_index(path):
+    """Map each tensor name in a .index file to (dtype, shape, shard, offset, size)"""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    footer = data[-48:]
+    if struct.unpack('<Q', footer[-8:])[0] != TABLE_MAGIC:
+        raise ValueError('{} is not a checkpoint index'.format(path))
+    _, i = read_varint(footer, 0)
+    _, i = read_varint(footer, i)
+    index_offset, i = read_varint(footer, i)
+    index_size, i = read_varint(footer, i)
+
+    entries = {}
+    for _, handle in read_block(data, index_offset, index_size):
+        block_offset, j = read_varint(handle, 0)
+        block_size, _ = read_varint(handle, j)
+        for key, value in read_block(data, block_offset, block_size):
+            if not key:
+                continue  # header entry
+            entry = dict(read_proto(value))
+            shape = [
+                dict(read_proto(dim)).get(1, 0)
+                for field, dim in read_proto(entry.get(2, b'')) if field == 2
+            ]
+            entries[key.decode('utf-8')] = (
+                DTYPES[entry[1]],
+                tuple(shape),
+                entry.get(3, 0),
+                entry.get(4, 0),
+                entry.get(5, 0),
+            )
+    return entries
+
+
+def iter_checkpoint(prefix, prefix_filter='model/'):
+    """
+    Yield (name, array) for every tensor under prefix_filter, one at a time
+    :prefix : checkpoint prefix, e.g. models/124M/model.ckpt
+    :prefix_filter : only load variables whose names start with this
+    """
+    entries = read_index(prefix + '.index')
+    num_shards = 1 + max(x[2] for x in entries.values())
+    for name in sorted(entries):
+        dtype, shape, shard, offset, size = entries[name]
+        if not name.startswith(prefix_filter):
+            continue
+        path = '{}.data-{:05d}-of-{:05d}'.format(prefix, shard, num_shards)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            yield name, np.frombuffer(
+                f.read(size),
+                dtype=np.dtype(dtype).newbyteorder('<'),
+            ).reshape(shape)
+
+
+def load_checkpoint(prefix, prefix_filter='model/'):
+    """Load every tensor under prefix_filter from a checkpoint"""
+    return dict(iter_checkpoint(prefix, prefix_filter=prefix_filter))
+
+
+def latest_checkpoint(model_dir):
+    """Same as tf.train.latest_checkpoint for a single model folder"""
+    with open(os.path.join(model_dir, 'checkpoint')) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key.strip() == 'model_checkpoint_path':
+                path = value.strip().strip('"')
+                if not os.path.isabs(path):
+                    path = os.path.join(model_dir, path)
+                # the released checkpoints point to paths on openai's machines
+                if not os.path.exists(path + '.index'):
+                    path = os.path.join(model_dir, os.path.basename(path))
+                return path
+    raise ValueError('No checkpoint found in {}'.format(model_dir))
@@ -0,0 +1,132 @@
+"""Convert a GPT-2 checkpoint into a flat, memory-mappable weight file
+
+weights.bin holds every model variable back to back, each starting on an
+ALIGNMENT byte boundary. weights.json maps variable names to their dtype,
+shape and offset so that np_model can map the file read-only and build
+zero-copy views, sharing the page cache between processes. Reduced
+precisions (see quantize.py) are written to weights.<precision>.bin, by
+np_model.load_params the first time they are used.
+"""
+
+import os
+import sys
+import json
+import fire
+import numpy as np
+
+import quantize
+import checkpoint
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+ALIGNMENT = 64
+
+
+def weight_files(model_dir, precision='float32'):
+    """Return the paths of the weight file and its index"""
+    name = 'weights' if precision == 'float32' else 'weights.' + precision
+    return (
+        os.path.join(model_dir, name + '.bin'),
+        os.path.join(model_dir, name + '.json'),
+    )
+
+
+def has_weights(model_dir, precision='float32'):
+    return os.path.exists(weight_files(model_dir, precision)[1])
+
+
+def load_weights(model_dir, precision='float32'):
+    """Return a dict of read-only arrays backed by the mapped weight file"""
+    weights_path, index_path = weight_files(model_dir, precision)
+    with open(index_path) as f:
+        index = json.load(f)
+    data = np.memmap(
+        weights_path,
+        dtype=np.uint8,
+        mode='r',
+    )
+    return {
+        name: np.frombuffer(
+            data,
+            dtype=np.dtype(entry['dtype']),
+            count=int(np.prod(entry['shape'], dtype=np.int64)),
+            offset=entry['offset'],
+        ).reshape(entry['shape'])
+        for name, entry in index['tensors'].items()
+    }
+
+
+def write_weights(model_dir, tensors, precision='float32'):
+    """
+    Write (name, array) pairs to the weight file of model_dir. Both files
+    are written next to their final paths and then moved into place, the
+    index last, so a partially converted model is never picked up and
+    processes that mapped the old file keep reading it.
+    """
+    weights_path, index_path = weight_files(model_dir, precision)
+    index = {'alignment': ALIGNMENT, 'precision': precision, 'tensors': {}}
+    offset = 0
+    tmp = '.{}.tmp'.format(os.getpid())
+    try:
+        with open(weights_path + tmp, 'wb') as f:
+            for name, value in tensors:
+                value = np.ascontiguousarray(value)
+                padding = -offset % ALIGNMENT
+                f.write(b'\0' * padding)
+                offset += padding
+                index['tensors'][name] = {
+                    'dtype': value.dtype.newbyteorder('<').str,
+                    'shape': list(value.shape),
+                    'offset': offset,
+                }
+                f.write(
+                    value.astype(index['tensors'][name]['dtype']).tobytes())
+                offset += value.nbytes
+        with open(index_path + tmp, 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+    except BaseException:
+        for path in [weights_path + tmp, index_path + tmp]:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    os.replace(weights_path + tmp, weights_path)
+    os.replace(index_path + tmp, index_path)
+
+
+def source_tensors(model_dir):
+    """
+    Yield the (name, array) pairs of the float32 weights of model_dir, from
+    the mapped weight file if there is one, else from the checkpoint
+    """
+    if has_weights(model_dir):
+        yield from load_weights(model_dir).items()
+    else:
+        yield from checkpoint.iter_checkpoint(
+            checkpoint.latest_checkpoint(model_dir))
+
+
+def convert(
+        model_name='124M',
+        models_dir=os.path.join(DIR, 'models'),
+        precision='float32',
+):
+    """
+    Convert the weights of a downloaded model. Reduced precisions are
+    quantized from the float32 weight file if it exists.
+    :model_name=124M : String, which model to convert
+    :models_dir : path to parent folder containing model subfolders
+    :precision=float32 : String, one of float32, float16 or int8
+    """
+    model_dir = os.path.join(
+        os.path.expanduser(os.path.expandvars(models_dir)), model_name)
+    write_weights(
+        model_dir,
+        quantize.quantize(source_tensors(model_dir), precision),
+        precision,
+    )
+    print('Wrote {}'.format(weight_files(model_dir, precision)[0]),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    fire.Fire(convert)
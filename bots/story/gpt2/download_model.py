@@ -3,6 +3,9 @@ import sys
 import requests
 from tqdm import tqdm
 
+import convert
+import encoder
+
 DIR = os.path.dirname(os.path.realpath(__file__))
 
 if len(sys.argv) != 2:
@@ -47,3 +50,9 @@ for filename in [
             for chunk in r.iter_content(chunk_size=chunk_size):
                 f.write(chunk)
                 pbar.update(chunk_size)
+
+# one-time conversion to the memory-mapped format used by the numpy backend
+convert.convert(model, models_dir=os.path.join(DIR, 'models'))
+
+# compiled tokenizer, so that later processes skip parsing the text files
+encoder.get_encoder(model, os.path.join(DIR, 'models'))
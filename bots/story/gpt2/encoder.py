@@ -1,9 +1,26 @@
 """Byte pair encoding utilities"""
 
 import os
+import sys
 import json
+import heapq
+import itertools
+import struct
+import threading
+import numpy as np
 import regex as re
+from array import array
 from functools import lru_cache
+from collections import OrderedDict
+
+# compiled form of encoder.json and vocab.bpe (see write_compiled)
+COMPILED_FILE = 'encoder.bin'
+COMPILED_MAGIC = b'GPT2BPE1'
+COMPILED_HEADER = struct.Struct('<8sIIII')
+
+# a sentence ends with terminal punctuation, possibly inside quotes/brackets,
+# which both the stop conditions and StoryBot's trimming of texts look for
+SENTENCE_END = re.compile(r'''[.!?]['"’”)\]]*\s*$''')
 
 @lru_cache()
 def bytes_to_unicode():
@@ -39,78 +56,225 @@ def get_pairs(word):
         prev_char = char
     return pairs
 
+def pad_left(token_lists, pad=0):
+    """
+    Stack token_lists into a [len(token_lists), longest] int32 array, padded
+    on the left with pad, and return it with the int32 array of the number
+    of padding tokens each row starts with (the pad of np_model.model)
+    """
+    lengths = np.array([len(tokens) for tokens in token_lists], dtype=np.int32)
+    width = lengths.max(initial=0)
+    batch = np.full((len(token_lists), width), pad, dtype=np.int32)
+    for row, tokens in zip(batch, token_lists):
+        row[width - len(tokens):] = tokens
+    return batch, width - lengths
+
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors='replace'):
+    def __init__(self, encoder, bpe_merges, errors='replace', cache_size=2**16, byte_encoder=None):
         self.encoder = encoder
-        self.decoder = {v:k for k,v in self.encoder.items()}
+        self.decoder = dict(zip(self.encoder.values(), self.encoder.keys()))
         self.errors = errors # how to handle errors in decoding
-        self.byte_encoder = bytes_to_unicode()
+        self.byte_encoder = byte_encoder or bytes_to_unicode()
         self.byte_decoder = {v:k for k, v in self.byte_encoder.items()}
-        self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        # str.translate tables between latin-1 decoded bytes and byte symbols
+        self.byte_encode_table = {k:ord(v) for k, v in self.byte_encoder.items()}
+        self.byte_decode_table = {ord(v):k for k, v in self.byte_encoder.items()}
+        self.bpe_ranks = dict(zip(bpe_merges, itertools.count()))
+        # least recently used words are dropped beyond cache_size; the lock
+        # lets several threads encode with one Encoder (see worker.py)
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
 
+    def cache_info(self):
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'size': len(self.cache),
+            'max_size': self.cache_size,
+        }
+
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
+        with self.cache_lock:
+            word = self.cache.get(token)
+            if word is not None:
+                self.cache.move_to_end(token)
+                self.cache_hits += 1
+                return word
+            self.cache_misses += 1
 
-        if not pairs:
+        symbols = list(token)
+        if len(symbols) < 2:
             return token
 
-        while True:
-            bigram = min(pairs, key = lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                    new_word.append(first+second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
-        self.cache[token] = word
+        # symbols form a linked list; merged-away symbols become None
+        ranks = self.bpe_ranks
+        next_ = list(range(1, len(symbols))) + [-1]
+        prev = list(range(-1, len(symbols) - 1))
+        heap = [(ranks[pair], i)
+                for i, pair in enumerate(zip(symbols, symbols[1:]))
+                if pair in ranks]
+        heapq.heapify(heap)
+
+        while heap:
+            # merge every occurrence of the lowest ranked pair left to right,
+            # and only then queue the pairs those merges created, exactly like
+            # rescanning the word for the best pair after each round
+            rank = heap[0][0]
+            created = []
+            while heap and heap[0][0] == rank:
+                _, i = heapq.heappop(heap)
+                j = next_[i] if symbols[i] is not None else -1
+                if j == -1 or ranks.get((symbols[i], symbols[j])) != rank:
+                    continue  # stale entry
+                symbols[i] += symbols[j]
+                symbols[j] = None
+                next_[i] = next_[j]
+                if next_[i] != -1:
+                    prev[next_[i]] = i
+                    created.append(i)
+                if prev[i] != -1:
+                    created.append(prev[i])
+            for i in created:
+                if symbols[i] is not None and next_[i] != -1:
+                    pair = (symbols[i], symbols[next_[i]])
+                    if pair in ranks:
+                        heapq.heappush(heap, (ranks[pair], i))
+
+        word = ' '.join(symbol for symbol in symbols if symbol is not None)
+        with self.cache_lock:
+            self.cache[token] = word
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
         return word
 
     def encode(self, text):
         bpe_tokens = []
         for token in re.findall(self.pat, text):
-            token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
+            token = token.encode('utf-8').decode('latin-1').translate(self.byte_encode_table)
             bpe_tokens.extend(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
         return bpe_tokens
 
+    def decode_bytes(self, tokens):
+        """UTF-8 bytes of tokens, which may end inside a character"""
+        text = ''.join(map(self.decoder.__getitem__, tokens))
+        return text.translate(self.byte_decode_table).encode('latin-1')
+
     def decode(self, tokens):
-        text = ''.join([self.decoder[token] for token in tokens])
-        text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors=self.errors)
-        return text
+        return self.decode_bytes(tokens).decode('utf-8', errors=self.errors)
+
+    def encode_batch(self, texts, pad=0):
+        """Encode texts into one left padded batch, see pad_left"""
+        return pad_left([self.encode(text) for text in texts], pad)
+
+    def decode_batch(self, token_arrays, pads=None, lengths=None):
+        """
+        Decode each row of token_arrays after its entry in pads (the padding
+        counts of pad_left) and up to its entry in lengths, if given
+        """
+        if pads is None:
+            pads = [0] * len(token_arrays)
+        if lengths is None:
+            lengths = [None] * len(token_arrays)
+        return [self.decode(np.asarray(tokens)[pad:][:n].tolist()) for tokens, pad, n in zip(token_arrays, pads, lengths)]
+
+def write_compiled(path, encoder, bpe_merges, byte_encoder):
+    """
+    Write the vocabulary, merges and byte table as one file: a header, then
+    the byte table characters and all symbols as newline separated UTF-8
+    (byte-level symbols never contain a newline), then int32 token ids and
+    int32 symbol index pairs for the merges in rank order.
+    """
+    symbols = list(encoder)
+    index = {symbol: i for i, symbol in enumerate(symbols)}
+    for pair in bpe_merges:
+        for symbol in pair:
+            if symbol not in index:
+                index[symbol] = len(symbols)
+                symbols.append(symbol)
+    strings = [byte_encoder[b] for b in range(2**8)] + symbols
+    if any('\n' in string for string in strings):
+        raise ValueError('Symbols must not contain newlines')
+    blob = '\n'.join(strings).encode('utf-8')
+    ids = array('i', encoder.values())
+    merges = array('i', (index[symbol] for pair in bpe_merges for symbol in pair))
+    if sys.byteorder == 'big':
+        ids.byteswap()
+        merges.byteswap()
+
+    with open(path + '.{}.tmp'.format(os.getpid()), 'wb') as f:
+        f.write(COMPILED_HEADER.pack(COMPILED_MAGIC, len(encoder), len(symbols), len(bpe_merges), len(blob)))
+        f.write(blob)
+        f.write(ids.tobytes())
+        f.write(merges.tobytes())
+    os.replace(path + '.{}.tmp'.format(os.getpid()), path)
+
+
+def read_compiled(path):
+    """
+    Return the encoder dict, an iterator over the merges in rank order and
+    the byte table of a compiled file
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, n_tokens, n_symbols, n_merges, blob_size = COMPILED_HEADER.unpack_from(data)
+    if magic != COMPILED_MAGIC:
+        raise ValueError('Not a compiled encoder: {}'.format(path))
+    offset = COMPILED_HEADER.size
+    strings = data[offset:offset + blob_size].decode('utf-8').split('\n')
+    offset += blob_size
+    ids = array('i', data[offset:offset + 4 * n_tokens])
+    offset += 4 * n_tokens
+    merges = array('i', data[offset:offset + 8 * n_merges])
+    if sys.byteorder == 'big':
+        ids.byteswap()
+        merges.byteswap()
+    if len(strings) != 2**8 + n_symbols or len(merges) != 2 * n_merges:
+        raise ValueError('Truncated compiled encoder: {}'.format(path))
+
+    symbols = strings[2**8:]
+    encoder = dict(zip(symbols, ids))
+    bpe_merges = zip(map(symbols.__getitem__, merges[0::2]), map(symbols.__getitem__, merges[1::2]))
+    return encoder, bpe_merges, dict(enumerate(strings[:2**8]))
+
+
+def get_encoder(model_name, models_dir, compiled=True):
+    """
+    Load the encoder of a model, from its compiled file if that is newer than
+    encoder.json and vocab.bpe. Otherwise the text files are parsed and the
+    compiled file is (re)written for the next process.
+    """
+    model_dir = os.path.join(models_dir, model_name)
+    compiled_path = os.path.join(model_dir, COMPILED_FILE)
+    sources = [os.path.join(model_dir, name) for name in ['encoder.json', 'vocab.bpe']]
+    if compiled:
+        try:
+            mtime = os.path.getmtime(compiled_path)
+            if all(not os.path.exists(path) or os.path.getmtime(path) <= mtime for path in sources):
+                encoder, bpe_merges, byte_encoder = read_compiled(compiled_path)
+                return Encoder(
+                    encoder=encoder,
+                    bpe_merges=bpe_merges,
+                    byte_encoder=byte_encoder,
+                )
+        except (OSError, ValueError, struct.error):
+            pass
 
-def get_encoder(model_name, models_dir):
-    with open(os.path.join(models_dir, model_name, 'encoder.json'), 'r') as f:
+    with open(sources[0], 'r') as f:
         encoder = json.load(f)
-    with open(os.path.join(models_dir, model_name, 'vocab.bpe'), 'r', encoding="utf-8") as f:
+    with open(sources[1], 'r', encoding="utf-8") as f:
         bpe_data = f.read()
     bpe_merges = [tuple(merge_str.split()) for merge_str in bpe_data.split('\n')[1:-1]]
+    if compiled:
+        try:
+            write_compiled(compiled_path, encoder, bpe_merges, bytes_to_unicode())
+        except (OSError, ValueError):
+            pass
     return Encoder(
         encoder=encoder,
         bpe_merges=bpe_merges,
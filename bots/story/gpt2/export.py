@@ -0,0 +1,118 @@
+"""Export sampling graphs of the tf backend as a SavedModel
+
+Building the sample_sequence graph in Python and restoring the checkpoint
+into it dominates the start of every generate_text.py run. This writes the
+graphs for the given generation settings, together with the model
+variables, to saved_model/ in the model folder, where sample.Generator
+loads them without constructing any graph. Settings that were exported
+before are kept, so the folder collects every configuration in use.
+
+The keys and values of the sampling loop live in variables that are
+written in place, so the graph can't be frozen into constants (nor would
+the larger models fit the 2GB limit of a single GraphDef).
+"""
+
+import os
+import sys
+import json
+import fire
+import shutil
+import logging
+import warnings
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def export(
+        model_name='124M',
+        models_dir=os.path.join(DIR, 'models'),
+        seed=None,
+        batch_size=1,
+        length=None,
+        temperature=1,
+        top_k=0,
+        top_p=1,
+        stop_eos=False,
+        stop_sentences=0,
+        min_length=0,
+):
+    """
+    Export the sampling graph for one set of generation settings, which
+    take the same values as in generate_text.py
+    :model_name=124M : String, which model to export
+    :models_dir : path to parent folder containing model subfolders
+    :seed=None : Integer seed baked into the random ops, has to match the
+     seed of later runs
+    """
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=FutureWarning)
+        import tensorflow as tf
+        import sample
+    tf.get_logger().setLevel(logging.ERROR)
+
+    generator = sample.Generator(
+        model_name=model_name,
+        models_dir=models_dir,
+        seed=seed,
+    )
+    if length is None:
+        length = generator.hparams.n_ctx // 2
+    settings = [
+        dict(batch_size=batch_size, length=length, temperature=temperature,
+             top_k=top_k, top_p=top_p, stop_eos=stop_eos,
+             stop_sentences=stop_sentences, min_length=min_length)
+    ]
+    # build the graphs of earlier exports again, next to the new one
+    generator.exported = set()
+    try:
+        with open(os.path.join(generator.export_dir, sample.EXPORT_INDEX)) as f:
+            index = json.load(f)
+        if index['version'] == sample.EXPORT_VERSION and index['seed'] == seed:
+            settings += [x for x in index['settings'] if x not in settings]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    signatures = {}
+    for x in settings:
+        stop = generator.stop_conditions(
+            x['stop_eos'], x['stop_sentences'], x['min_length'])
+        _, context, output = generator.sampler(
+            x['batch_size'], x['length'], x['temperature'], x['top_k'],
+            x['top_p'], **stop)
+        name = sample.sampler_name(sample.sampler_key(
+            x['batch_size'], x['length'], x['temperature'], x['top_k'],
+            x['top_p'], **stop))
+        signatures[name] = \
+            tf.saved_model.signature_def_utils.predict_signature_def(
+                inputs={'context': context}, outputs=output)
+
+    export_dir = generator.export_dir
+    tmp_dir = '{}.{}.tmp'.format(export_dir, os.getpid())
+    with generator.sess.graph.as_default():
+        builder = tf.saved_model.builder.SavedModelBuilder(tmp_dir)
+        builder.add_meta_graph_and_variables(
+            generator.sess,
+            [tf.saved_model.tag_constants.SERVING],
+            signature_def_map=signatures,
+            main_op=tf.local_variables_initializer(),
+        )
+        builder.save()
+    generator.close()
+
+    with open(os.path.join(tmp_dir, sample.EXPORT_INDEX), 'w') as f:
+        json.dump({
+            'version': sample.EXPORT_VERSION,
+            'seed': seed,
+            'samplers': sorted(signatures),
+            'settings': settings,
+        }, f, indent=2)
+    if os.path.exists(export_dir):
+        shutil.rmtree(export_dir)
+    os.rename(tmp_dir, export_dir)
+    print('Wrote {} sampling graphs to {}'.format(len(signatures), export_dir),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    fire.Fire(export)
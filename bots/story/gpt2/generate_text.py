@@ -1,22 +1,58 @@
 import os
+import sys
 import fire
 import json
 import logging
-import numpy as np
 import warnings
 
-with warnings.catch_warnings():
-    warnings.filterwarnings("ignore", category=FutureWarning)
-    import tensorflow as tf
-    import model
-    import sample
-    import encoder
-
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
-tf.get_logger().setLevel(logging.ERROR)
+import memory
 
 DIR = os.path.dirname(os.path.realpath(__file__))
 
+BACKENDS = ('tf', 'numpy')
+
+
+def get_generator(
+        backend='tf',
+        precision='float32',
+        prefix_cache=False,
+        draft_model=None,
+        draft_length=4,
+        sliding_window=False,
+        retain_prefix=0,
+        **kwargs
+):
+    """Load a generator for the given backend, importing only what it needs"""
+    if backend == 'tf':
+        if precision != 'float32':
+            raise ValueError('The tf backend only supports float32 weights')
+        if prefix_cache:
+            raise ValueError('The tf backend does not support prefix_cache')
+        if draft_model:
+            raise ValueError('The tf backend does not support draft_model')
+        if sliding_window:
+            raise ValueError('The tf backend does not support sliding_window')
+        os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category=FutureWarning)
+            import tensorflow as tf
+            import sample
+        tf.get_logger().setLevel(logging.ERROR)
+        return sample.Generator(**kwargs)
+    elif backend == 'numpy':
+        import np_sample
+        return np_sample.Generator(
+            precision=precision,
+            prefix_cache=prefix_cache,
+            draft_model=draft_model,
+            draft_length=draft_length,
+            sliding_window=sliding_window,
+            retain_prefix=retain_prefix,
+            **kwargs,
+        )
+    raise ValueError('Unknown backend {}, expected one of {}'.format(
+        backend, ', '.join(BACKENDS)))
+
 
 def generate_text(
         raw_text,
@@ -29,6 +65,19 @@ def generate_text(
         top_k=0,
         top_p=1,
         models_dir=os.path.join(DIR, 'models'),
+        backend='tf',
+        precision='float32',
+        stop_eos=False,
+        stop_sentences=0,
+        min_length=0,
+        prefix_cache=False,
+        json_output=False,
+        draft_model=None,
+        draft_length=4,
+        memory_budget=None,
+        sliding_window=False,
+        retain_prefix=0,
+        stream=False,
 ):
     """
     Interactively run the model
@@ -50,53 +99,126 @@ def generate_text(
      special setting meaning no restrictions. 40 generally is a good value.
      :models_dir : path to parent folder containing model subfolders
      (i.e. contains the <model_name> folder)
+    :backend=tf : String, tf for the TensorFlow graph or numpy for the
+     TensorFlow-free implementation in np_model.py
+    :precision=float32 : String, weight storage for the numpy backend, one
+     of float32, float16 or int8 (see quantize.py)
+    :stop_eos=False : Boolean, end a sample at <|endoftext|>
+    :stop_sentences=0 : Integer, if set, end a sample once it completes this
+     many sentences and has at least min_length tokens
+    :min_length=0 : Integer, see stop_sentences
+    :prefix_cache=False : Boolean, numpy backend only: save the keys and
+     values of the context so later contexts that extend it only process
+     the new tokens (see prefix_cache.py)
+    :json_output=False : Boolean, print a single JSON list of objects with
+     the 'text' of each sample and its 'score', the mean token log-prob
+    :draft_model=None : String, numpy backend only: a smaller model (e.g.
+     124M) that drafts tokens for model_name to verify in batches, without
+     changing the distribution of samples (speculative decoding)
+    :draft_length=4 : Integer, tokens drafted per verification
+    :memory_budget=None : Integer, bytes generation may use on top of the
+     weights. The context is cut to the longest tail that fits, which by
+     default is sized to the memory available (see memory.py). Running out
+     of memory anyway exits with status memory.EXIT_OUT_OF_MEMORY.
+    :sliding_window=False : Boolean, numpy backend only: allow length to
+     exceed the model's window, which slides forward once context and
+     samples fill it, so the start of the context falls out of view
+    :retain_prefix=0 : Integer, number of context tokens at the start that
+     stay in view when the window slides
+    :stream=False : Boolean, print text as it is decoded (batch_size 1
+     only), or with json_output, one JSON list per token of the 'chunk' of
+     text each sample added, its 'text' and 'score' so far and whether it
+     is 'done' (see Generator.stream). The numpy backend decodes step by
+     step; the tf backend only streams once each batch is complete.
     """
+    if stream and not json_output and batch_size != 1:
+        raise ValueError('Streaming text needs batch_size 1, or json_output')
 
-    models_dir = os.path.expanduser(os.path.expandvars(models_dir))
-    if batch_size is None:
-        batch_size = 1
-    assert nsamples % batch_size == 0
-
-    enc = encoder.get_encoder(model_name, models_dir)
-    hparams = model.default_hparams()
-    with open(os.path.join(models_dir, model_name, 'hparams.json')) as f:
-        hparams.override_from_dict(json.load(f))
-
-    if length is None:
-        length = hparams.n_ctx // 2
-    elif length > hparams.n_ctx:
-        raise ValueError(
-            "Can't get samples longer than window size: %s" % hparams.n_ctx)
-
-    with tf.Session(graph=tf.Graph()) as sess:
-        context = tf.placeholder(tf.int32, [batch_size, None])
-        np.random.seed(seed)
-        tf.set_random_seed(seed)
-        output = sample.sample_sequence(
-            hparams=hparams,
-            length=length,
-            context=context,
+    try:
+        run(
+            raw_text,
+            stream=stream,
+            json_output=json_output,
+            backend=backend,
+            precision=precision,
+            prefix_cache=prefix_cache,
+            draft_model=draft_model,
+            draft_length=draft_length,
+            model_name=model_name,
+            seed=seed,
+            models_dir=models_dir,
+            memory_budget=memory_budget,
+            sliding_window=sliding_window,
+            retain_prefix=retain_prefix,
+            nsamples=nsamples,
             batch_size=batch_size,
+            length=length,
             temperature=temperature,
             top_k=top_k,
-            top_p=top_p)
+            top_p=top_p,
+            stop_eos=stop_eos,
+            stop_sentences=stop_sentences,
+            min_length=min_length,
+        )
+    except MemoryError as e:
+        print('Out of memory: {}'.format(e), file=sys.stderr)
+        sys.exit(memory.EXIT_OUT_OF_MEMORY)
 
-        saver = tf.train.Saver()
-        ckpt = tf.train.latest_checkpoint(os.path.join(models_dir, model_name))
-        saver.restore(sess, ckpt)
 
-        context_tokens = enc.encode(raw_text)
-        generated = 0
+def run(
+        raw_text,
+        stream,
+        json_output,
+        nsamples,
+        batch_size,
+        backend,
+        precision,
+        prefix_cache,
+        draft_model,
+        draft_length,
+        model_name,
+        seed,
+        models_dir,
+        memory_budget,
+        sliding_window,
+        retain_prefix,
+        **kwargs
+):
+    generator = get_generator(
+        backend,
+        precision=precision,
+        prefix_cache=prefix_cache,
+        draft_model=draft_model,
+        draft_length=draft_length,
+        model_name=model_name,
+        seed=seed,
+        models_dir=models_dir,
+        memory_budget=memory_budget,
+        sliding_window=sliding_window,
+        retain_prefix=retain_prefix,
+    )
+    try:
+        if not stream:
+            candidates = generator.generate_scored(
+                raw_text, nsamples=nsamples, batch_size=batch_size, **kwargs)
+            if json_output:
+                print(json.dumps(candidates))
+            else:
+                for candidate in candidates:
+                    print(candidate['text'])
+            return
+
         for _ in range(nsamples // batch_size):
-            out = sess.run(
-                output,
-                feed_dict={
-                    context: [context_tokens for _ in range(batch_size)]
-                })[:, len(context_tokens):]
-            for i in range(batch_size):
-                generated += 1
-                text = enc.decode(out[i])
-                print(text)
+            for rows in generator.stream(raw_text, batch_size=batch_size,
+                                         **kwargs):
+                if json_output:
+                    print(json.dumps(rows), flush=True)
+                else:
+                    print(rows[0]['chunk'], end='', flush=True)
+            if not json_output:
+                print()
+    finally:
+        generator.close()
 
 
 if __name__ == '__main__':
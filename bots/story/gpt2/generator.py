@@ -0,0 +1,429 @@
+"""Backend-independent parts of text generation"""
+
+import os
+import sys
+import json
+import codecs
+import numpy as np
+
+import memory
+import encoder
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+EOS = '<|endoftext|>'
+
+
+def drain(steps):
+    """Run a step generator (see Generator.sample_steps) and return its result"""
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+
+class Generator:
+    """
+    Base class for generation backends. Keeps the encoder and the loaded
+    model around so that repeated calls only pay for sampling. Subclasses
+    load the model in __init__ and implement default_hparams and sample,
+    and sample_steps if they can yield tokens as they are decoded.
+    :model_name=124M : String, which model to use
+    :seed=None : Integer seed for random number generators
+    :models_dir : path to parent folder containing model subfolders
+    :memory_budget=None : Integer, bytes generation may use on top of the
+     weights, defaults to a share of the currently available memory
+    """
+
+    # key into memory.CALIBRATION
+    backend = None
+
+    # whether sample can continue past the n_ctx window
+    sliding_window = False
+
+    # whether batch_steps can decode different contexts together
+    batching = False
+
+    def __init__(
+            self,
+            model_name='124M',
+            seed=None,
+            models_dir=os.path.join(DIR, 'models'),
+            memory_budget=None,
+    ):
+        models_dir = os.path.expanduser(os.path.expandvars(models_dir))
+        self.model_name = model_name
+        self.models_dir = models_dir
+        self.model_dir = os.path.join(models_dir, model_name)
+        self.seed = seed
+        self.memory_budget = memory_budget
+        self.enc = encoder.get_encoder(model_name, models_dir)
+        self.hparams = self.default_hparams()
+        with open(os.path.join(self.model_dir, 'hparams.json')) as f:
+            self.hparams.override_from_dict(json.load(f))
+
+        self._sentence_ends = None
+
+    def default_hparams(self):
+        raise NotImplementedError
+
+    def sentence_ends(self):
+        """Boolean table over the vocabulary of tokens that end a sentence"""
+        if self._sentence_ends is None:
+            self._sentence_ends = np.array([
+                bool(encoder.SENTENCE_END.search(self.enc.decode([token])))
+                for token in range(self.hparams.n_vocab)
+            ])
+        return self._sentence_ends
+
+    def stop_conditions(self, stop_eos=False, stop_sentences=0, min_length=0):
+        """
+        Keyword arguments for sample_sequence that end a row once it produces
+        EOS (if stop_eos) or completes stop_sentences sentences with at least
+        min_length tokens. Returns an empty dict when nothing is enabled.
+        """
+        stop = {}
+        if stop_eos:
+            stop['stop_tokens'] = np.zeros(self.hparams.n_vocab, dtype=bool)
+            stop['stop_tokens'][self.enc.encoder[EOS]] = True
+        if stop_sentences:
+            stop['sentence_ends'] = self.sentence_ends()
+            stop['stop_sentences'] = stop_sentences
+            stop['min_length'] = min_length
+        return stop
+
+    def weight_bytes(self):
+        """Memory of the weights once loaded"""
+        return memory.weight_bytes(self.hparams)
+
+    def weight_format(self):
+        """Which stored form of the weights is loaded"""
+        return 'checkpoint'
+
+    def save_weights(self):
+        """
+        Store the loaded weights in the form that loads fastest, unless they
+        are already (see registry.py)
+        """
+        pass
+
+    def generation_bytes(self, batch_size, context_length, length):
+        """Estimated peak memory of sample on top of the loaded weights"""
+        return memory.generation_bytes(
+            self.hparams,
+            batch_size,
+            context_length,
+            length,
+            backend=self.backend,
+        )
+
+    def budget(self):
+        """Bytes a generation may use, see memory_budget"""
+        if self.memory_budget is None:
+            return int(memory.available_bytes() * memory.SAFETY_FRACTION)
+        return self.memory_budget
+
+    def fit_context(self, context_tokens, batch_size, length):
+        """
+        Keep the longest tail of context_tokens that fits in the window next
+        to length new tokens and within the memory budget. Raises
+        MemoryError if not even one token of context fits.
+        """
+        budget = self.budget()
+        window = length
+        if self.sliding_window:
+            # leave at least half of the window to samples before it slides
+            window = min(length, self.hparams.n_ctx // 2)
+        limit = memory.max_context(
+            lambda n: self.generation_bytes(batch_size, n, length),
+            budget,
+            min(len(context_tokens), self.hparams.n_ctx - window),
+        )
+        if context_tokens and not limit:
+            raise MemoryError(
+                'Generating {} tokens with batch size {} needs about {} MB, '
+                'but only {} MB are available'.format(
+                    length, batch_size,
+                    self.generation_bytes(batch_size, 1, length) // 2**20,
+                    budget // 2**20))
+        if limit < len(context_tokens):
+            print('Using the last {} of {} context tokens to fit the window '
+                  'and {} MB of memory'.format(limit, len(context_tokens),
+                                               budget // 2**20),
+                  file=sys.stderr)
+        return context_tokens[len(context_tokens) - limit:]
+
+    def sample(
+            self,
+            context_tokens,
+            batch_size,
+            length,
+            temperature,
+            top_k,
+            top_p,
+            **stop
+    ):
+        """
+        Return a dict with 'tokens', a [batch_size, steps] array of tokens
+        following the context, 'lengths', the number of tokens each row
+        produced before meeting a stop condition (at most steps <= length),
+        and 'scores', the mean log-probability of those tokens
+        """
+        raise NotImplementedError
+
+    def sample_steps(
+            self,
+            context_tokens,
+            batch_size,
+            length,
+            temperature,
+            top_k,
+            top_p,
+            **stop
+    ):
+        """
+        Generator yielding a dict of the 'samples' of each row, their
+        'log_probs' and the rows that are 'done' after every token, and
+        returning the result of sample. Closing it stops decoding.
+
+        This default runs sample to the end before replaying it, with the
+        score of each row standing in for the log-prob of every token.
+        Backends that decode step by step in Python override it.
+        """
+        out = self.sample(
+            context_tokens,
+            batch_size=batch_size,
+            length=length,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            **stop,
+        )
+        for i in range(out['tokens'].shape[1]):
+            yield {
+                'samples': out['tokens'][:, i],
+                'log_probs': out['scores'],
+                'done': out['lengths'] <= i + 1,
+            }
+        return out
+
+    def batch_steps(
+            self,
+            contexts,
+            lengths,
+            temperature,
+            top_k,
+            top_p,
+            **stop
+    ):
+        """
+        Like sample_steps, for rows with different context tokens and
+        lengths. The stop conditions are given per row (see
+        np_sample.track). Only backends with batching implement it.
+        """
+        raise NotImplementedError
+
+    def prepare(self, raw_text, batch_size, length):
+        """Return the context tokens to use and the checked length"""
+        if length is None:
+            length = self.hparams.n_ctx // 2
+        elif length >= self.hparams.n_ctx and not self.sliding_window:
+            raise ValueError("Can't get samples longer than window size: %s" %
+                             self.hparams.n_ctx)
+        return self.fit_context(self.enc.encode(raw_text), batch_size,
+                                length), length
+
+    def generate(self, *args, **kwargs):
+        """Return the sampled texts, see generate_scored"""
+        return [c['text'] for c in self.generate_scored(*args, **kwargs)]
+
+    def generate_scored(
+            self,
+            raw_text,
+            nsamples=1,
+            batch_size=1,
+            length=None,
+            temperature=1,
+            top_k=0,
+            top_p=1,
+            stop_eos=False,
+            stop_sentences=0,
+            min_length=0,
+    ):
+        """
+        Return a list of nsamples dicts with the sampled 'text' and its
+        'score', the mean log-probability per token under the model. Rows of
+        a batch are sampled together, so batch_size = nsamples gets all
+        candidates from a single pass.
+        """
+        if batch_size is None:
+            batch_size = 1
+        assert nsamples % batch_size == 0
+
+        context_tokens, length = self.prepare(raw_text, batch_size, length)
+        stop = self.stop_conditions(stop_eos, stop_sentences, min_length)
+        candidates = []
+        for _ in range(nsamples // batch_size):
+            out = self.sample(
+                context_tokens,
+                batch_size=batch_size,
+                length=length,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                **stop,
+            )
+            lengths = out['lengths']
+            if stop_eos:
+                # drop the EOS a row stopped at
+                ends = out['tokens'][np.arange(len(lengths)), lengths - 1]
+                lengths = lengths - ((lengths > 0) &
+                                     (ends == self.enc.encoder[EOS]))
+            for text, score in zip(
+                    self.enc.decode_batch(out['tokens'], lengths=lengths),
+                    out['scores']):
+                candidates.append({'text': text, 'score': float(score)})
+        return candidates
+
+    def stream(
+            self,
+            raw_text,
+            batch_size=1,
+            length=None,
+            temperature=1,
+            top_k=0,
+            top_p=1,
+            stop_eos=False,
+            stop_sentences=0,
+            min_length=0,
+    ):
+        """
+        Generator over the decoding of batch_size samples, see
+        generate_scored for the arguments. After every token it yields a
+        list with a dict per row: the 'chunk' of text the token added (empty
+        while it ends inside a UTF-8 character, or once the row is done),
+        the 'text' so far, its 'score' so far and whether the row is 'done'.
+        Stop iterating, or close it, to cancel.
+        """
+        context_tokens, length = self.prepare(raw_text, batch_size, length)
+        steps = self.stream_batch(
+            [
+                dict(
+                    context_tokens=context_tokens,
+                    batch_size=batch_size,
+                    length=length,
+                    stop_eos=stop_eos,
+                    stop_sentences=stop_sentences,
+                    min_length=min_length,
+                )
+            ],
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+        )
+        try:
+            for rows, in steps:
+                yield rows
+        finally:
+            steps.close()
+
+    def stream_batch(self, requests, temperature=1, top_k=0, top_p=1):
+        """
+        Generator over the decoding of several requests in one batch, each a
+        dict of the context_tokens and length returned by prepare, the
+        batch_size and optionally the stop conditions of stream. After every
+        token it yields a list of the rows of each request, see stream.
+        More than one request needs batching.
+        """
+        eos = self.enc.encoder[EOS]
+        lengths, eoses = [], []
+        for request in requests:
+            lengths += [request['length']] * request['batch_size']
+            eoses += [eos if request.get('stop_eos') else None
+                      ] * request['batch_size']
+        if len(requests) == 1:
+            request = requests[0]
+            steps = self.sample_steps(
+                request['context_tokens'],
+                batch_size=request['batch_size'],
+                length=request['length'],
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                **self.stop_conditions(request.get('stop_eos', False),
+                                       request.get('stop_sentences', 0),
+                                       request.get('min_length', 0)),
+            )
+        else:
+            steps = self.batch_steps(
+                [
+                    request['context_tokens'] for request in requests
+                    for _ in range(request['batch_size'])
+                ],
+                lengths,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                **self.row_stop_conditions(requests),
+            )
+
+        decoders = [
+            codecs.getincrementaldecoder('utf-8')(errors=self.enc.errors)
+            for _ in lengths
+        ]
+        rows = [{'chunk': '', 'text': '', 'score': 0.0, 'done': False}
+                for _ in lengths]
+        totals = np.zeros(len(rows))
+        counts = np.zeros(len(rows), dtype=np.int32)
+        offsets = np.cumsum([0] + [r['batch_size'] for r in requests])
+        try:
+            for n, step in enumerate(steps):
+                for i, row in enumerate(rows):
+                    row['chunk'] = ''
+                    if row['done']:
+                        continue
+                    token = int(step['samples'][i])
+                    totals[i] += step['log_probs'][i]
+                    counts[i] += 1
+                    row['done'] = bool(step['done'][i]) or n + 1 == lengths[i]
+                    if token != eoses[i]:
+                        row['chunk'] = decoders[i].decode(
+                            self.enc.decode_bytes([token]))
+                    if row['done']:
+                        row['chunk'] += decoders[i].decode(b'', final=True)
+                    row['text'] += row['chunk']
+                    row['score'] = float(totals[i] / counts[i])
+                yield [[dict(row) for row in rows[start:end]]
+                       for start, end in zip(offsets[:-1], offsets[1:])]
+        finally:
+            steps.close()
+
+    def row_stop_conditions(self, requests):
+        """
+        stop_conditions with a value per row of requests (see stream_batch),
+        for batch_steps
+        """
+        rows = sum(request['batch_size'] for request in requests)
+        stop = {
+            'stop_tokens': np.zeros((rows, self.hparams.n_vocab), dtype=bool),
+            # never reached by rows that don't stop at sentences
+            'stop_sentences': np.full(rows, np.iinfo(np.int32).max),
+            'min_length': np.zeros(rows, dtype=np.int32),
+        }
+        i = 0
+        for request in requests:
+            rows = slice(i, i + request['batch_size'])
+            i += request['batch_size']
+            if request.get('stop_eos'):
+                stop['stop_tokens'][rows, self.enc.encoder[EOS]] = True
+            if request.get('stop_sentences'):
+                stop['sentence_ends'] = self.sentence_ends()
+                stop['stop_sentences'][rows] = request['stop_sentences']
+                stop['min_length'][rows] = request.get('min_length', 0)
+        if 'sentence_ends' not in stop:
+            stop['stop_sentences'] = 0
+        return stop
+
+    def close(self):
+        pass
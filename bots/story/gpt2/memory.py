@@ -0,0 +1,108 @@
+"""Peak memory estimates for generation
+
+Generation is sized before it runs: the estimate for a batch and sequence
+length is compared with the memory that is actually available, and the
+context is cut to the longest one that fits. The estimate counts the key
+and value buffers, the largest per-layer temporaries (attention scores or
+the MLP hidden layer) and the logits, only computed for the last position
+of the context, scaled by factors measured with bench_memory.py.
+
+Only the standard library is used here, so StoryBot can import it too.
+"""
+
+import os
+
+# generate_text.py exits with this status when it runs out of memory
+EXIT_OUT_OF_MEMORY = 3
+
+BYTES = {'float32': 4, 'float16': 2, 'int8': 1}
+
+# copies of each kind of array alive at the peak, and fixed overhead in
+# bytes, per backend (see bench_memory.py)
+CALIBRATION = {
+    'numpy': {
+        'past': 1.0,
+        'attention': 3.5,
+        'mlp': 3.0,
+        'logits': 2.0,
+        'overhead': 32 * 2**20,
+    },
+    'tf': {
+        'past': 2.0,
+        'attention': 4.0,
+        'mlp': 4.0,
+        'logits': 3.0,
+        'overhead': 256 * 2**20,
+    },
+}
+
+# share of the available memory generation may plan to use
+SAFETY_FRACTION = 0.8
+
+
+def parameters(hparams):
+    """Number of weights of a model"""
+    n_embd = hparams.n_embd
+    return ((hparams.n_vocab + hparams.n_ctx) * n_embd + hparams.n_layer *
+            (12 * n_embd**2 + 13 * n_embd) + 2 * n_embd)
+
+
+def weight_bytes(hparams, precision='float32'):
+    return parameters(hparams) * BYTES[precision]
+
+
+def cache_bytes(hparams, batch_size, window=None):
+    """Bytes of the keys and values of batch_size rows over window tokens"""
+    if window is None:
+        window = hparams.n_ctx
+    return batch_size * hparams.n_layer * 2 * hparams.n_embd * window * 4
+
+
+def generation_bytes(
+        hparams,
+        batch_size,
+        context_length,
+        length,
+        backend='numpy',
+):
+    """Estimated peak bytes on top of the weights for one sample_sequence"""
+    factors = CALIBRATION[backend]
+    total = context_length + length
+    # the tf backend preallocates and attends over the whole window
+    window = hparams.n_ctx if backend == 'tf' else min(total, hparams.n_ctx)
+    # a sliding window runs most of the window through the model again
+    prefill = context_length if total <= hparams.n_ctx else hparams.n_ctx
+    past = cache_bytes(hparams, batch_size, window)
+    attention = batch_size * hparams.n_head * prefill * window * 4
+    mlp = batch_size * prefill * 4 * hparams.n_embd * 4
+    logits = batch_size * hparams.n_vocab * 4
+    return int(factors['past'] * past +
+               max(factors['attention'] * attention, factors['mlp'] * mlp) +
+               factors['logits'] * logits + factors['overhead'])
+
+
+def available_bytes():
+    """Memory available to new allocations without swapping"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def max_context(estimate, budget, limit):
+    """
+    Longest context length up to limit for which estimate(context_length)
+    stays within budget, or 0 if not even a single token fits
+    """
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate(middle) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return low
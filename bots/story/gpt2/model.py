@@ -66,11 +66,21 @@ def attention_mask(nd, ns, *, dtype):
     return tf.cast(m, dtype)
 
 
-def attn(x, scope, n_state, *, past, hparams):
+def cache_mask(nd, ns, cache_length, *, dtype):
+    """1's where key j was written no later than query i, i.e. j <= cache_length + i."""
+    i = tf.range(nd)[:,None]
+    j = tf.range(ns)
+    m = j <= cache_length + i
+    return tf.cast(m, dtype)
+
+
+def attn(x, scope, n_state, *, past, hparams, cache=None, cache_length=None):
     assert x.shape.ndims == 3  # Should be [batch, sequence, features]
     assert n_state % hparams.n_head == 0
     if past is not None:
         assert past.shape.ndims == 5  # Should be [batch, 2, heads, sequence, features], where 2 is [k, v]
+    if cache is not None:
+        assert past is None  # cache is (k, v) variables of shape [batch, heads, n_ctx, features]
 
     def split_heads(x):
         # From [batch, sequence, features] to [batch, heads, sequence, features]
@@ -83,7 +93,10 @@ def attn(x, scope, n_state, *, past, hparams):
     def mask_attn_weights(w):
         # w has shape [batch, heads, dst_sequence, src_sequence], where information flows from src to dst.
         _, _, nd, ns = shape_list(w)
-        b = attention_mask(nd, ns, dtype=w.dtype)
+        if cache is not None:
+            b = cache_mask(nd, ns, cache_length, dtype=w.dtype)
+        else:
+            b = attention_mask(nd, ns, dtype=w.dtype)
         b = tf.reshape(b, [1, 1, nd, ns])
         w = w*b - tf.cast(1e10, w.dtype)*(1-b)
         return w
@@ -106,6 +119,16 @@ def attn(x, scope, n_state, *, past, hparams):
             pk, pv = tf.unstack(past, axis=1)
             k = tf.concat([pk, k], axis=-2)
             v = tf.concat([pv, v], axis=-2)
+        elif cache is not None:
+            # write the new keys and values in place, then attend over the
+            # whole buffer with unwritten positions masked out
+            nd = shape_list(k)[2]
+            updates = [
+                c[:, :, cache_length:cache_length + nd].assign(t)
+                for c, t in zip(cache, [k, v])
+            ]
+            with tf.control_dependencies(updates):
+                k, v = [c.read_value() for c in cache]
         a = multihead_attn(q, k, v)
         a = merge_heads(a)
         a = conv1d(a, 'c_proj', n_state)
@@ -120,10 +143,10 @@ def mlp(x, scope, n_state, *, hparams):
         return h2
 
 
-def block(x, scope, *, past, hparams):
+def block(x, scope, *, past, hparams, cache=None, cache_length=None):
     with tf.variable_scope(scope):
         nx = x.shape[-1].value
-        a, present = attn(norm(x, 'ln_1'), 'attn', nx, past=past, hparams=hparams)
+        a, present = attn(norm(x, 'ln_1'), 'attn', nx, past=past, hparams=hparams, cache=cache, cache_length=cache_length)
         x = x + a
         m = mlp(norm(x, 'ln_2'), 'mlp', nx*4, hparams=hparams)
         x = x + m
@@ -132,6 +155,26 @@ def block(x, scope, *, past, hparams):
 def past_shape(*, hparams, batch_size=None, sequence=None):
     return [batch_size, hparams.n_layer, 2, hparams.n_head, sequence, hparams.n_embd // hparams.n_head]
 
+def cache_variables(*, hparams, batch_size):
+    """Preallocate per-layer (k, v) buffers of shape [batch, heads, n_ctx, features].
+
+    They are local variables, so tf.train.Saver neither saves nor restores them.
+    """
+    shape = [batch_size, hparams.n_head, hparams.n_ctx, hparams.n_embd // hparams.n_head]
+    with tf.variable_scope(None, default_name='cache'):
+        return [
+            tuple(
+                tf.get_variable(
+                    'h%d_%s' % (layer, name),
+                    shape,
+                    initializer=tf.zeros_initializer(),
+                    trainable=False,
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                    use_resource=True,
+                ) for name in ['k', 'v'])
+            for layer in range(hparams.n_layer)
+        ]
+
 def expand_tile(value, size):
     """Add a new axis of given size."""
     value = tf.convert_to_tensor(value, name='value')
@@ -144,7 +187,14 @@ def positions_for(tokens, past_length):
     return expand_tile(past_length + tf.range(nsteps), batch_size)
 
 
-def model(hparams, X, past=None, scope='model', reuse=False):
+def model(hparams, X, past=None, scope='model', reuse=False, cache=None, cache_length=None, last_only=False):
+    """Run the transformer over X.
+
+    Either pass past (the stacked presents of earlier tokens, extended by concatenation), or
+    pass cache (from cache_variables) with cache_length earlier tokens already written to it.
+    With last_only, logits are only computed for the last position of X ([batch, 1, n_vocab]),
+    which skips most of the output projection when sampling.
+    """
     with tf.variable_scope(scope, reuse=reuse):
         results = {}
         batch, sequence = shape_list(X)
@@ -153,17 +203,24 @@ def model(hparams, X, past=None, scope='model', reuse=False):
                              initializer=tf.random_normal_initializer(stddev=0.01))
         wte = tf.get_variable('wte', [hparams.n_vocab, hparams.n_embd],
                              initializer=tf.random_normal_initializer(stddev=0.02))
-        past_length = 0 if past is None else tf.shape(past)[-2]
+        if cache is not None:
+            past_length = cache_length
+        else:
+            past_length = 0 if past is None else tf.shape(past)[-2]
         h = tf.gather(wte, X) + tf.gather(wpe, positions_for(X, past_length))
 
         # Transformer
         presents = []
         pasts = tf.unstack(past, axis=1) if past is not None else [None] * hparams.n_layer
-        assert len(pasts) == hparams.n_layer
-        for layer, past in enumerate(pasts):
-            h, present = block(h, 'h%d' % layer, past=past, hparams=hparams)
+        caches = cache if cache is not None else [None] * hparams.n_layer
+        assert len(pasts) == hparams.n_layer and len(caches) == hparams.n_layer
+        for layer, (past, layer_cache) in enumerate(zip(pasts, caches)):
+            h, present = block(h, 'h%d' % layer, past=past, hparams=hparams, cache=layer_cache, cache_length=cache_length)
             presents.append(present)
         results['present'] = tf.stack(presents, axis=1)
+        if last_only:
+            h = h[:, -1:]
+            sequence = 1
         h = norm(h, 'ln_f')
 
         # Language model loss.  Do tokens <n predict token n?
@@ -172,3 +229,21 @@ def model(hparams, X, past=None, scope='model', reuse=False):
         logits = tf.reshape(logits, [batch, sequence, hparams.n_vocab])
         results['logits'] = logits
         return results
+
+
+def prefill(hparams, X, cache, scope='model', reuse=False):
+    """Write the keys and values of X ([batch, sequence]) to cache from position 0.
+
+    Returns the logits of the last position only, [batch, n_vocab].
+    """
+    return model(hparams=hparams, X=X, scope=scope, reuse=reuse, cache=cache, cache_length=0,
+                 last_only=True)['logits'][:, -1]
+
+
+def decode(hparams, tokens, cache, cache_length, scope='model', reuse=False):
+    """Run one token per row ([batch, 1]) at position cache_length, adding it to cache.
+
+    Returns its logits, [batch, n_vocab].
+    """
+    return model(hparams=hparams, X=tokens, scope=scope, reuse=reuse, cache=cache, cache_length=cache_length,
+                 last_only=True)['logits'][:, -1]
@@ -0,0 +1,215 @@
+"""NumPy implementation of the GPT-2 forward pass in model.py
+
+Parameters are a dict from TensorFlow variable names (e.g.
+model/h0/attn/c_attn/w) to arrays, so the same checkpoints can be used
+(or the memory-mapped weights written by convert.py).
+Unlike model.model, past is a buffer preallocated for the whole sequence;
+keys and values for new tokens are written into it at past_length, which
+makes incremental decoding free of copies. Rows of different lengths can
+share a batch by padding them on the left, see model.
+"""
+
+import sys
+import numpy as np
+
+import convert
+import quantize
+
+
+class HParams:
+    """Minimal stand-in for tf.contrib.training.HParams"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def override_from_dict(self, values):
+        self.__dict__.update(values)
+        return self
+
+    def values(self):
+        return dict(self.__dict__)
+
+
+def default_hparams():
+    return HParams(
+        n_vocab=0,
+        n_ctx=1024,
+        n_embd=768,
+        n_head=12,
+        n_layer=12,
+    )
+
+
+def load_params(model_dir, precision='float32'):
+    """
+    Map the converted weights, converting them first if there are none yet.
+    If they can't be written, the weights are quantized in memory instead,
+    one variable at a time.
+    """
+    if not convert.has_weights(model_dir, precision):
+        try:
+            convert.write_weights(
+                model_dir,
+                quantize.quantize(convert.source_tensors(model_dir),
+                                  precision),
+                precision,
+            )
+        except OSError as e:
+            print('Could not convert the weights of {}: {}'.format(
+                model_dir, e),
+                  file=sys.stderr)
+            return dict(
+                quantize.quantize(convert.source_tensors(model_dir),
+                                  precision))
+    return convert.load_weights(model_dir, precision)
+
+
+def softmax(x, axis=-1):
+    x = x - np.max(x, axis=axis, keepdims=True)
+    ex = np.exp(x)
+    return ex / np.sum(ex, axis=axis, keepdims=True)
+
+
+def gelu(x):
+    return 0.5 * x * (1 + np.tanh(np.sqrt(2 / np.pi) * (x + 0.044715 * x**3)))
+
+
+def norm(x, scope, *, params, axis=-1, epsilon=1e-5):
+    """Normalize to mean = 0, std = 1, then do a diagonal affine transform."""
+    u = np.mean(x, axis=axis, keepdims=True)
+    s = np.mean(np.square(x - u), axis=axis, keepdims=True)
+    x = (x - u) / np.sqrt(s + epsilon)
+    return x * params[scope + '/g'] + params[scope + '/b']
+
+
+def conv1d(x, scope, *, params):
+    return quantize.matmul(x, params, scope + '/w') + params[scope + '/b']
+
+
+def attention_mask(nd, ns, *, dtype):
+    """1's in the lower triangle, counting from the lower right corner."""
+    i = np.arange(nd)[:, None]
+    j = np.arange(ns)
+    return (i >= j - ns + nd).astype(dtype)
+
+
+def split_heads(x, n_head):
+    # From [batch, sequence, features] to [batch, heads, sequence, features]
+    batch, sequence, features = x.shape
+    return x.reshape(batch, sequence, n_head,
+                     features // n_head).transpose(0, 2, 1, 3)
+
+
+def merge_heads(x):
+    # Reverse of split_heads
+    batch, heads, sequence, features = x.shape
+    return x.transpose(0, 2, 1, 3).reshape(batch, sequence, heads * features)
+
+
+def attn(x, scope, *, past, past_length, pad, params, hparams):
+    # past has shape [batch, 2, heads, n_ctx, features], where 2 is [k, v]
+    nd = x.shape[1]
+    ns = past_length + nd
+    c = conv1d(x, scope + '/c_attn', params=params)
+    q, k, v = (split_heads(t, hparams.n_head) for t in np.split(c, 3, axis=2))
+    past[:, 0, :, past_length:ns] = k
+    past[:, 1, :, past_length:ns] = v
+    k = past[:, 0, :, :ns]
+    v = past[:, 1, :, :ns]
+
+    w = q @ k.swapaxes(-1, -2)
+    w = w / np.sqrt(np.float32(v.shape[-1]))
+    b = attention_mask(nd, ns, dtype=w.dtype)
+    if pad is not None:
+        # padding is never attended to
+        b = b * (np.arange(ns) >= pad[:, None, None, None])
+    w = w * b - np.float32(1e10) * (1 - b)
+    a = softmax(w) @ v
+    return conv1d(merge_heads(a), scope + '/c_proj', params=params)
+
+
+def mlp(x, scope, *, params):
+    h = gelu(conv1d(x, scope + '/c_fc', params=params))
+    return conv1d(h, scope + '/c_proj', params=params)
+
+
+def block(x, scope, *, past, past_length, pad, params, hparams):
+    a = attn(
+        norm(x, scope + '/ln_1', params=params),
+        scope + '/attn',
+        past=past,
+        past_length=past_length,
+        pad=pad,
+        params=params,
+        hparams=hparams,
+    )
+    x = x + a
+    m = mlp(norm(x, scope + '/ln_2', params=params), scope + '/mlp',
+            params=params)
+    return x + m
+
+
+def past_shape(*, hparams, batch_size=None, sequence=None):
+    return [
+        batch_size, hparams.n_layer, 2, hparams.n_head, sequence,
+        hparams.n_embd // hparams.n_head
+    ]
+
+
+def allocate_past(hparams, batch_size, sequence=None):
+    if sequence is None:
+        sequence = hparams.n_ctx
+    return np.zeros(
+        past_shape(hparams=hparams, batch_size=batch_size,
+                   sequence=sequence),
+        dtype=np.float32,
+    )
+
+
+def model(params, hparams, X, past=None, past_length=0, pad=None,
+          last_only=False, scope='model'):
+    """
+    Run X ([batch, sequence] tokens) at positions past_length onwards. pad
+    optionally gives the number of padding tokens each row starts with
+    ([batch]); those are masked out and position embeddings of the row
+    count from its first real token. With last_only, logits are only
+    computed for the last position ([batch, 1, n_vocab]), which skips most
+    of the projection onto the vocabulary when prefilling a context.
+    """
+    X = np.asarray(X)
+    batch, sequence = X.shape
+    if past is None:
+        past = allocate_past(hparams, batch, sequence)
+    if past_length + sequence > past.shape[-2]:
+        raise ValueError('Sequence does not fit in past buffer of size {}'.format(
+            past.shape[-2]))
+
+    results = {}
+    positions = slice(past_length, past_length + sequence)
+    if pad is not None:
+        pad = np.asarray(pad)
+        positions = np.maximum(
+            np.arange(past_length, past_length + sequence) - pad[:, None], 0)
+    h = quantize.dequantize(params, scope + '/wte', X) + quantize.dequantize(
+        params, scope + '/wpe', positions)
+
+    # Transformer
+    for layer in range(hparams.n_layer):
+        h = block(
+            h,
+            '{}/h{}'.format(scope, layer),
+            past=past[:, layer],
+            past_length=past_length,
+            pad=pad,
+            params=params,
+            hparams=hparams,
+        )
+    results['present'] = past
+    if last_only:
+        h = h[:, -1:]
+    h = norm(h, scope + '/ln_f', params=params)
+
+    # Language model loss.  Do tokens <n predict token n?
+    results['logits'] = quantize.matmul(
+        h, params, scope + '/wte', transpose=True)
+    return results
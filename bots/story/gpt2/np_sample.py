@@ -0,0 +1,586 @@
+import os
+import json
+import functools
+import numpy as np
+
+import memory
+import convert
+import encoder
+import np_model
+import generator
+from prefix_cache import PrefixCache
+
+
+def top_k_logits(logits, k):
+    if k == 0:
+        # no truncation
+        return logits
+    min_values = np.partition(logits, -k, axis=-1)[:, -k, np.newaxis]
+    return np.where(logits < min_values, np.float32(-1e10), logits)
+
+
+def top_p_logits(logits, p):
+    """Nucleus sampling"""
+    sorted_logits = -np.sort(-logits, axis=-1)
+    cumulative_probs = np.cumsum(np_model.softmax(sorted_logits), axis=-1)
+    # number of indices to include
+    indices = np.maximum(np.sum(cumulative_probs <= p, axis=-1) - 1, 0)
+    min_values = sorted_logits[np.arange(len(logits)), indices][:, np.newaxis]
+    return np.where(logits < min_values, np.float32(-1e10), logits)
+
+
+def sample_logits(logits, rng, *, top_k=0, top_p=1):
+    """
+    Draw one token per row of logits. With top_k set, a single partial
+    selection picks the candidates and nucleus filtering and sampling only
+    look at that slice. Nucleus filtering is skipped when top_p >= 1.
+    """
+    if top_k == 0:
+        if top_p < 1:
+            logits = top_p_logits(logits, p=top_p)
+        return multinomial(logits, rng)
+
+    indices = np.argpartition(logits, -top_k, axis=-1)[:, -top_k:]
+    values = np.take_along_axis(logits, indices, axis=-1)
+    if top_p < 1:
+        values = top_p_logits(values, p=top_p)
+    choices = multinomial(values, rng)
+    return indices[np.arange(len(indices)), choices]
+
+
+def multinomial(logits, rng):
+    """Draw one sample per row of logits"""
+    cdf = np.cumsum(np_model.softmax(logits.astype(np.float64)), axis=-1)
+    u = rng.random_sample((len(logits), 1)) * cdf[:, -1:]
+    return np.minimum(np.sum(cdf < u, axis=-1), logits.shape[-1] - 1)
+
+
+def token_log_probs(logits, tokens):
+    """Log-probability of tokens[i] under the distribution of logits[i]"""
+    logits = logits.astype(np.float64)
+    top = logits.max(axis=-1)
+    total = top + np.log(np.exp(logits - top[:, np.newaxis]).sum(axis=-1))
+    return logits[np.arange(len(tokens)), tokens] - total
+
+
+def track(
+        i,
+        samples,
+        done,
+        sentences,
+        lengths,
+        *,
+        stop_tokens=None,
+        sentence_ends=None,
+        stop_sentences=0,
+        min_length=0,
+        max_lengths=None,
+):
+    """
+    Update the stop state of each row in place with the samples of step i.
+    stop_tokens is a table over the vocabulary, or one per row; the other
+    conditions may also be given per row.
+    """
+    finished = np.zeros(len(samples), dtype=bool)
+    if stop_tokens is not None:
+        if stop_tokens.ndim == 2:
+            finished |= stop_tokens[np.arange(len(samples)), samples]
+        else:
+            finished |= stop_tokens[samples]
+    if np.any(stop_sentences):
+        ends = sentence_ends[samples]
+        sentences += ends
+        finished |= ends & (sentences >= stop_sentences) & (i + 1 >= min_length)
+    if max_lengths is not None:
+        finished |= i + 1 >= max_lengths
+    lengths[finished & ~done] = i + 1
+    done |= finished
+
+
+def sample_sequence(**kwargs):
+    """
+    Sample up to length tokens after context, see sample_steps for the
+    arguments. Returns a dict of 'tokens' (context and samples), 'lengths'
+    (samples per row up to its stop), 'scores' (mean log-probability of
+    those samples under the model), 'present' and 'slides'.
+    """
+    return generator.drain(sample_steps(**kwargs))
+
+
+def sample_steps(
+        *,
+        params,
+        hparams,
+        length,
+        context,
+        rng,
+        temperature=1,
+        top_k=0,
+        top_p=1,
+        stop_tokens=None,
+        sentence_ends=None,
+        stop_sentences=0,
+        min_length=0,
+        max_lengths=None,
+        prefix_presents=None,
+        retain_prefix=0,
+        window_shift=None,
+        pad=None,
+):
+    """
+    Generator sampling up to length tokens after context, which yields a
+    dict of the 'samples' of each row, their 'log_probs' and the rows that
+    are 'done' after every token, and returns the result of
+    sample_sequence. Closing it stops decoding.
+
+    A row is done once it samples one of stop_tokens, or ends its
+    stop_sentences-th sentence (per the sentence_ends table) after at least
+    min_length tokens, or reaches its entry of max_lengths; decoding stops
+    as soon as every row is done.
+
+    Rows of context may differ in length if they are padded on the left
+    with pad[i] tokens each (see np_model.model). Padded rows can't slide.
+
+    prefix_presents are the keys and values of a shared prefix of context
+    ([n_layer, 2, heads, prefix_length, features], see prefix_cache.py);
+    only the rest of the context is run through the model.
+
+    Once context and samples fill the n_ctx window, it slides: the first
+    retain_prefix tokens keep their keys and values, the window_shift
+    (default n_ctx // 4) tokens after them are dropped and the rest is run
+    through the model again at its new positions, which the learned
+    position embeddings require. 'slides' counts how often that happened.
+    """
+    stop = dict(stop_tokens=stop_tokens,
+                sentence_ends=sentence_ends,
+                stop_sentences=stop_sentences,
+                min_length=min_length,
+                max_lengths=max_lengths)
+    context = np.asarray(context, dtype=np.int32)
+    batch_size, context_length = context.shape
+    if pad is not None and context_length + length > hparams.n_ctx:
+        raise ValueError('Padded rows must fit the window')
+    if window_shift is None:
+        window_shift = hparams.n_ctx // 4
+    if not 0 < window_shift < hparams.n_ctx - retain_prefix:
+        raise ValueError(
+            'window_shift must leave room for retain_prefix and one token')
+    past = np_model.allocate_past(hparams, batch_size,
+                                  min(context_length + length, hparams.n_ctx))
+    position = context_length
+    slides = 0
+    prefix_length = 0
+    if prefix_presents is not None:
+        prefix_length = prefix_presents.shape[-2]
+        past[..., :prefix_length, :] = prefix_presents
+    output = np.empty((batch_size, length), dtype=np.int32)
+    lengths = np.full(batch_size, length)
+    done = np.zeros(batch_size, dtype=bool)
+    sentences = np.zeros(batch_size, dtype=np.int32)
+    total_log_probs = np.zeros(batch_size)
+
+    logits = np_model.model(
+        params,
+        hparams,
+        context[:, prefix_length:],
+        past=past,
+        past_length=prefix_length,
+        pad=pad,
+        last_only=True,
+    )['logits']
+    for i in range(length):
+        logits = logits[:, -1, :hparams.n_vocab]
+        samples = sample_logits(logits / np.float32(temperature),
+                                rng,
+                                top_k=top_k,
+                                top_p=top_p)
+        output[:, i] = samples
+        log_probs = token_log_probs(logits, samples)
+        total_log_probs[~done] += log_probs[~done]
+        track(i, samples, done, sentences, lengths, **stop)
+        yield {'samples': samples, 'log_probs': log_probs, 'done': done}
+        if done.all():
+            output = output[:, :i + 1]
+            break
+
+        if i + 1 < length and position == hparams.n_ctx:
+            recent = hparams.n_ctx - retain_prefix - window_shift
+            logits = np_model.model(
+                params,
+                hparams,
+                np.concatenate([context, output[:, :i + 1]],
+                               axis=1)[:, -recent:],
+                past=past,
+                past_length=retain_prefix,
+                last_only=True,
+            )['logits']
+            position = retain_prefix + recent
+            slides += 1
+        elif i + 1 < length:
+            logits = np_model.model(
+                params,
+                hparams,
+                samples[:, np.newaxis],
+                past=past,
+                past_length=position,
+                pad=pad,
+            )['logits']
+            position += 1
+
+    return {
+        'tokens': np.concatenate([context, output], axis=1),
+        'lengths': lengths,
+        'scores': total_log_probs / np.maximum(lengths, 1),
+        'present': past,
+        'slides': slides,
+    }
+
+
+def filtered_probs(logits, *, top_k=0, top_p=1):
+    """The distribution sample_logits draws from, as explicit probabilities"""
+    logits = top_k_logits(logits, k=top_k)
+    if top_p < 1:
+        logits = top_p_logits(logits, p=top_p)
+    return np_model.softmax(logits.astype(np.float64))
+
+
+def choice(probs, rng):
+    """Draw one index per row of (unnormalized) probabilities"""
+    cdf = np.cumsum(probs, axis=-1)
+    u = rng.random_sample((len(probs), 1)) * cdf[:, -1:]
+    return np.minimum(np.sum(cdf < u, axis=-1), probs.shape[-1] - 1)
+
+
+def speculative_sequence(**kwargs):
+    """
+    Speculative version of sample_sequence, see speculative_steps. Returns
+    the same dict as sample_sequence, plus the number of 'proposed' and
+    'accepted' draft tokens.
+    """
+    return generator.drain(speculative_steps(**kwargs))
+
+
+def speculative_steps(
+        *,
+        params,
+        hparams,
+        draft_params,
+        draft_hparams,
+        length,
+        context,
+        rng,
+        temperature=1,
+        top_k=0,
+        top_p=1,
+        draft_length=4,
+        stop_tokens=None,
+        sentence_ends=None,
+        stop_sentences=0,
+        min_length=0,
+        prefix_presents=None,
+):
+    """
+    Speculative version of sample_steps, yielding the tokens of a round one
+    by one once it is verified. Each round, the draft model
+    proposes draft_length tokens one at a time and the target model scores
+    all of them in one forward pass. A proposal is accepted with
+    probability min(1, p / q) (target over draft probability under the
+    same temperature, top_k and top_p); at the first rejection a token is
+    drawn from the normalized residual max(0, p - q) instead, and if
+    everything was accepted the target's next distribution is sampled too.
+    The samples thus follow exactly the distribution of sample_sequence.
+
+    Rows of a batch advance together by the fewest tokens accepted by any
+    row that isn't done. Keys and values of rejected tokens stay in the
+    buffers and are overwritten by the next round. prefix_presents only
+    apply to the target model.
+    """
+    stop = dict(stop_tokens=stop_tokens,
+                sentence_ends=sentence_ends,
+                stop_sentences=stop_sentences,
+                min_length=min_length)
+    assert hparams.n_vocab == draft_hparams.n_vocab, 'Vocabularies differ'
+    n_vocab = hparams.n_vocab
+    context = np.asarray(context, dtype=np.int32)
+    batch_size, context_length = context.shape
+    size = context_length + length + draft_length
+    past = np_model.allocate_past(hparams, batch_size, size)
+    draft_past = np_model.allocate_past(draft_hparams, batch_size, size)
+    tokens = np.zeros((batch_size, size), dtype=np.int32)
+    tokens[:, :context_length] = context
+    lengths = np.full(batch_size, length)
+    done = np.zeros(batch_size, dtype=bool)
+    sentences = np.zeros(batch_size, dtype=np.int32)
+    total_log_probs = np.zeros(batch_size)
+    proposed = accepted = 0
+
+    # the last token of the sequence is run through each model only once
+    # there is something to predict from it
+    prefix_length = 0
+    if prefix_presents is not None:
+        prefix_length = prefix_presents.shape[-2]
+        past[..., :prefix_length, :] = prefix_presents
+    if context_length - 1 > prefix_length:
+        np_model.model(params,
+                       hparams,
+                       context[:, prefix_length:-1],
+                       past=past,
+                       past_length=prefix_length,
+                       last_only=True)
+    if context_length > 1:
+        np_model.model(draft_params,
+                       draft_hparams,
+                       context[:, :-1],
+                       past=draft_past,
+                       last_only=True)
+    draft_position = context_length - 1
+
+    n = 0
+    while n < length and not done.all():
+        end = context_length + n
+        steps = min(draft_length, length - n - 1)
+
+        # propose
+        q = np.empty((batch_size, steps, n_vocab))
+        for j in range(steps):
+            logits = np_model.model(
+                draft_params,
+                draft_hparams,
+                tokens[:, draft_position:end + j],
+                past=draft_past,
+                past_length=draft_position,
+                last_only=True,
+            )['logits'][:, -1, :n_vocab]
+            draft_position = end + j
+            q[:, j] = filtered_probs(logits / np.float32(temperature),
+                                     top_k=top_k,
+                                     top_p=top_p)
+            tokens[:, end + j] = choice(q[:, j], rng)
+
+        # verify
+        logits = np_model.model(
+            params,
+            hparams,
+            tokens[:, end - 1:end + steps],
+            past=past,
+            past_length=end - 1,
+        )['logits'][..., :n_vocab]
+        p = filtered_probs(
+            (logits / np.float32(temperature)).reshape(-1, n_vocab),
+            top_k=top_k,
+            top_p=top_p,
+        ).reshape(batch_size, steps + 1, n_vocab)
+        drafts = tokens[:, end:end + steps]
+        rows, columns = np.arange(batch_size)[:, np.newaxis], np.arange(steps)
+        ratio = p[rows, columns, drafts] / q[rows, columns, drafts]
+        accepts = np.cumprod(rng.random_sample(ratio.shape) < ratio,
+                             axis=1).sum(axis=1)
+        k = accepts[~done].min()
+        proposed += steps * np.sum(~done)
+        accepted += accepts[~done].sum()
+
+        if k < steps:
+            residual = np.maximum(p[:, k] - q[:, k], 0)
+            empty = residual.sum(axis=-1) <= 0
+            residual[empty] = p[empty, k]
+            tokens[:, end + k] = np.where(accepts > k, drafts[:, k],
+                                          choice(residual, rng))
+        else:
+            tokens[:, end + k] = choice(p[:, k], rng)
+        draft_position = min(draft_position, end + k)
+
+        for j in range(k + 1):
+            samples = tokens[:, end + j]
+            log_probs = token_log_probs(logits[:, j], samples)
+            total_log_probs[~done] += log_probs[~done]
+            track(n, samples, done, sentences, lengths, **stop)
+            n += 1
+            yield {'samples': samples, 'log_probs': log_probs, 'done': done}
+            if done.all():
+                break
+
+    return {
+        'tokens': tokens[:, :context_length + n],
+        'lengths': lengths,
+        'scores': total_log_probs / np.maximum(lengths, 1),
+        'present': past,
+        'proposed': int(proposed),
+        'accepted': int(accepted),
+    }
+
+
+class Generator(generator.Generator):
+    """
+    NumPy backend, free of any TensorFlow dependency
+    :precision=float32 : String, weight storage (see quantize.py)
+    :prefix_cache=False : Boolean, save the keys and values of each context
+     but its last token and reuse the longest saved prefix of later contexts
+    :draft_model=None : String, if set, a smaller model with the same
+     vocabulary (e.g. 124M) that drafts tokens for speculative_sequence
+    :draft_length=4 : Integer, tokens drafted per round
+    :sliding_window=False : Boolean, allow samples longer than the window by
+     sliding it (see sample_steps), not with draft_model
+    :retain_prefix=0 : Integer, context tokens that stay in a sliding window
+
+    Without draft_model and sliding_window, different contexts can be
+    decoded together in a padded batch (see batch_steps).
+    """
+
+    backend = 'numpy'
+
+    def __init__(
+            self,
+            *args,
+            precision='float32',
+            prefix_cache=False,
+            draft_model=None,
+            draft_length=4,
+            sliding_window=False,
+            retain_prefix=0,
+            **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        if sliding_window and draft_model:
+            raise ValueError(
+                'sliding_window does not support speculative decoding')
+        self.sliding_window = sliding_window
+        self.retain_prefix = retain_prefix
+        self.batching = not (sliding_window or draft_model)
+        self.precision = precision
+        self.rng = np.random.RandomState(self.seed)
+        self.params = np_model.load_params(self.model_dir, precision)
+        self.mapped = convert.has_weights(self.model_dir, precision)
+        self.draft_length = draft_length
+        self.draft_params = None
+        self.draft_dir = None
+        if draft_model:
+            self.draft_dir = os.path.join(self.models_dir, draft_model)
+            self.draft_hparams = self.default_hparams()
+            with open(os.path.join(self.draft_dir, 'hparams.json')) as f:
+                self.draft_hparams.override_from_dict(json.load(f))
+            if self.draft_hparams.n_vocab != self.hparams.n_vocab:
+                raise ValueError('{} and {} have different vocabularies'.format(
+                    draft_model, self.model_name))
+            self.draft_params = np_model.load_params(self.draft_dir, precision)
+        self.prefix_cache = None
+        if prefix_cache:
+            self.prefix_cache = PrefixCache(
+                os.path.join(self.model_dir, 'prefix_cache'),
+                namespace='{}/{}'.format(self.model_name, precision),
+            )
+
+    def default_hparams(self):
+        return np_model.default_hparams()
+
+    def weight_bytes(self):
+        total = memory.weight_bytes(self.hparams, self.precision)
+        if self.draft_params is not None:
+            total += memory.weight_bytes(self.draft_hparams, self.precision)
+        return total
+
+    def weight_format(self):
+        return 'mapped weights' if self.mapped else 'checkpoint'
+
+    def save_weights(self):
+        """Write the weights that load_params couldn't convert, if any"""
+        for model_dir, params in [(self.model_dir, self.params),
+                                  (self.draft_dir, self.draft_params)]:
+            if params is not None and not convert.has_weights(
+                    model_dir, self.precision):
+                convert.write_weights(model_dir, params.items(),
+                                      self.precision)
+
+    def generation_bytes(self, batch_size, context_length, length):
+        total = super().generation_bytes(batch_size, context_length, length)
+        if self.draft_params is not None:
+            total += memory.generation_bytes(
+                self.draft_hparams,
+                batch_size,
+                context_length,
+                length + self.draft_length,
+                backend=self.backend,
+            )
+        return total
+
+    def sample(self, *args, **kwargs):
+        return generator.drain(self.sample_steps(*args, **kwargs))
+
+    def sample_steps(
+            self,
+            context_tokens,
+            batch_size,
+            length,
+            temperature,
+            top_k,
+            top_p,
+            **stop
+    ):
+        prefix_length, prefix_presents = 0, None
+        if self.prefix_cache is not None:
+            prefix_length, prefix_presents = self.prefix_cache.lookup(
+                context_tokens)
+
+        if self.draft_params is None:
+            steps = functools.partial(
+                sample_steps,
+                retain_prefix=min(self.retain_prefix, len(context_tokens)),
+            )
+        else:
+            steps = functools.partial(
+                speculative_steps,
+                draft_params=self.draft_params,
+                draft_hparams=self.draft_hparams,
+                draft_length=self.draft_length,
+            )
+
+        out = yield from steps(
+            params=self.params,
+            hparams=self.hparams,
+            length=length,
+            context=[context_tokens for _ in range(batch_size)],
+            rng=self.rng,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            prefix_presents=prefix_presents,
+            **stop,
+        )
+        # the last token may change once text is appended to the context,
+        # like a trailing '\n\n' that becomes two '\n' before the next entry
+        saved = len(context_tokens) - 1
+        if (self.prefix_cache is not None and saved > prefix_length and
+                not out.get('slides')):
+            self.prefix_cache.save(
+                context_tokens[:saved],
+                out['present'][0, ..., :saved, :],
+            )
+        out['tokens'] = out['tokens'][:, len(context_tokens):]
+        out['prefix_length'] = prefix_length
+        return out
+
+    def batch_steps(
+            self,
+            contexts,
+            lengths,
+            temperature,
+            top_k,
+            top_p,
+            **stop
+    ):
+        assert self.batching
+        context, pad = encoder.pad_left(contexts)
+        out = yield from sample_steps(
+            params=self.params,
+            hparams=self.hparams,
+            length=max(lengths),
+            context=context,
+            rng=self.rng,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            max_lengths=np.array(lengths),
+            pad=pad,
+            **stop,
+        )
+        out['tokens'] = out['tokens'][:, context.shape[1]:]
+        return out
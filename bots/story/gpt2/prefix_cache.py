@@ -0,0 +1,98 @@
+"""On-disk cache of attention keys and values for token prefixes
+
+After a context has been processed, its presents (the [n_layer, 2, heads,
+sequence, features] keys and values for one row) are saved under a hash of
+the context tokens. A later generation whose context extends a saved one
+loads those presents and only has to process the new tokens. Entries are
+keyed by model and weight precision, since both change the values.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+INDEX_FILE = 'index.json'
+
+
+class PrefixCache:
+    """
+    :directory : where entries are stored
+    :namespace : String mixed into every key, e.g. model name and precision
+    :max_entries=8 : Integer, least recently used entries beyond this are
+     deleted
+    """
+
+    def __init__(self, directory, namespace='', max_entries=8):
+        self.directory = directory
+        self.namespace = namespace
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, tokens):
+        digest = hashlib.sha256(self.namespace.encode('utf-8'))
+        digest.update(np.asarray(tokens, dtype='<i4').tobytes())
+        return digest.hexdigest()
+
+    def read_index(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_index(self, index):
+        path = os.path.join(self.directory, INDEX_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(path + '.tmp', path)
+
+    def lookup(self, tokens):
+        """
+        Return (length, presents) for the longest cached proper prefix of
+        tokens, or (0, None). At least one token is always left over, since
+        its logits are needed to start sampling.
+        """
+        index = self.read_index()
+        for length in sorted(set(index.values()), reverse=True):
+            if length >= len(tokens):
+                continue
+            key = self.key(tokens[:length])
+            if index.get(key) != length:
+                continue
+            try:
+                presents = np.load(
+                    os.path.join(self.directory, key + '.npy'),
+                    mmap_mode='r',
+                )
+            except (OSError, ValueError):
+                continue
+            os.utime(os.path.join(self.directory, key + '.npy'))
+            return length, presents
+        return 0, None
+
+    def save(self, tokens, presents):
+        """Store presents of shape [n_layer, 2, heads, len(tokens), features]"""
+        key = self.key(tokens)
+        path = os.path.join(self.directory, key + '.npy')
+        np.save(path + '.tmp.npy', np.ascontiguousarray(presents))
+        os.replace(path + '.tmp.npy', path)
+
+        index = self.read_index()
+        index[key] = len(tokens)
+
+        # evict the least recently used entries
+        def last_used(key):
+            try:
+                return os.path.getmtime(
+                    os.path.join(self.directory, key + '.npy'))
+            except OSError:
+                return 0
+
+        for old in sorted(index, key=last_used)[:-self.max_entries]:
+            del index[old]
+            try:
+                os.remove(os.path.join(self.directory, old + '.npy'))
+            except OSError:
+                pass
+        self.write_index(index)
@@ -0,0 +1,80 @@
+"""Reduced precision storage for GPT-2 weights
+
+float16 stores the conv1d matrices and both embeddings in half precision.
+int8 stores the conv1d matrices with one float32 scale per output channel
+and wte with one scale per vocabulary row, which serves both the embedding
+lookup and the output projection. Biases and layer norms stay float32.
+Quantized matrices are widened back to float32 right before they are used.
+"""
+
+import numpy as np
+
+PRECISIONS = ('float32', 'float16', 'int8')
+
+SCALE_SUFFIX = ':scale'
+
+
+def is_matrix(name):
+    return name.endswith('/w') or name.endswith('/wte')
+
+
+def quantize(tensors, precision):
+    """Yield (name, array) pairs of tensors stored at the given precision"""
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision {}, expected one of {}'.format(
+            precision, ', '.join(PRECISIONS)))
+
+    for name, value in tensors:
+        if precision == 'float16' and (is_matrix(name)
+                                       or name.endswith('/wpe')):
+            yield name, value.astype(np.float16)
+        elif precision == 'int8' and is_matrix(name):
+            # conv1d weights are [1, nx, nf] and scaled per output channel;
+            # wte is [n_vocab, n_embd] and scaled per row
+            axis = 1 if name.endswith('/wte') else -2
+            scale = np.max(np.abs(value), axis=axis, keepdims=True) / 127
+            scale[scale == 0] = 1
+            yield name, np.round(value / scale).astype(np.int8)
+            # one scale per output channel or row: [nf] or [n_vocab]
+            yield name + SCALE_SUFFIX, scale.reshape(-1).astype(np.float32)
+        else:
+            yield name, value
+
+
+def dequantize(params, name, index=None):
+    """Return params[name] as float32, optionally only the rows in index"""
+    value = params[name] if index is None else params[name][index]
+    scale = params.get(name + SCALE_SUFFIX)
+    if scale is None:
+        return value.astype(np.float32, copy=False)
+    if index is not None:
+        scale = scale[index]
+    if name.endswith('/wte'):
+        # one scale per row rather than per output channel
+        scale = scale[..., np.newaxis]
+    return value.astype(np.float32) * scale
+
+
+def matmul(x, params, name, transpose=False, chunk_size=8192):
+    """
+    Compute x @ params[name] (or its transpose) for a possibly quantized
+    matrix. Output channels are processed in chunks so that the widened
+    copy of a large matrix like wte never exists in full.
+    """
+    w = params[name]
+    w = w.reshape(w.shape[-2:])
+    scale = params.get(name + SCALE_SUFFIX)
+    if scale is not None:
+        # files from before scales were stored flat have [1, nf]
+        scale = scale.reshape(-1)
+    if w.dtype == np.float32:
+        return x @ (w.T if transpose else w)
+
+    w = w.T if transpose else w
+    out = np.empty(x.shape[:-1] + w.shape[-1:], dtype=np.float32)
+    for i in range(0, w.shape[-1], chunk_size):
+        out[..., i:i + chunk_size] = x @ w[:, i:i + chunk_size].astype(
+            np.float32)
+        if scale is not None:
+            out[..., i:i + chunk_size] *= scale[i:i + chunk_size]
+    return out
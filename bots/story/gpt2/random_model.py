@@ -0,0 +1,103 @@
+"""Models with random weights for benchmarks without downloaded checkpoints
+
+write_model fills a model folder the way download_model.py does: hparams,
+encoder.json and vocab.bpe, the weight file of the numpy backend (see
+convert.py) and optionally a checkpoint for the tf backend. The vocabulary
+is copied from another model, or, offline, is made of the 256 byte
+symbols and <|endoftext|> without any merges, so every byte is a token.
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+
+import convert
+import encoder
+
+# small enough to generate quickly on any machine
+TINY = {
+    'n_ctx': 512,
+    'n_embd': 64,
+    'n_head': 4,
+    'n_layer': 2,
+}
+
+
+def byte_vocabulary(model_dir):
+    """Write encoder.json and vocab.bpe with one token per byte"""
+    tokens = {symbol: b for b, symbol in encoder.bytes_to_unicode().items()}
+    tokens['<|endoftext|>'] = len(tokens)
+    with open(os.path.join(model_dir, 'encoder.json'), 'w') as f:
+        json.dump(tokens, f)
+    with open(os.path.join(model_dir, 'vocab.bpe'), 'w', encoding='utf-8') as f:
+        f.write('#version: 0.2\n')
+
+
+def random_tensors(hparams, rng):
+    """(name, array) pairs of a model with random weights"""
+    n_embd = hparams['n_embd']
+
+    def dense(scope, n_in, n_out):
+        yield scope + '/w', rng.normal(0, 0.02, [1, n_in, n_out])
+        yield scope + '/b', np.zeros([n_out])
+
+    def norm(scope):
+        yield scope + '/g', np.ones([n_embd])
+        yield scope + '/b', np.zeros([n_embd])
+
+    yield 'model/wte', rng.normal(0, 0.02, [hparams['n_vocab'], n_embd])
+    yield 'model/wpe', rng.normal(0, 0.01, [hparams['n_ctx'], n_embd])
+    for layer in range(hparams['n_layer']):
+        scope = 'model/h{}'.format(layer)
+        yield from norm(scope + '/ln_1')
+        yield from dense(scope + '/attn/c_attn', n_embd, 3 * n_embd)
+        yield from dense(scope + '/attn/c_proj', n_embd, n_embd)
+        yield from norm(scope + '/ln_2')
+        yield from dense(scope + '/mlp/c_fc', n_embd, 4 * n_embd)
+        yield from dense(scope + '/mlp/c_proj', 4 * n_embd, n_embd)
+    yield from norm('model/ln_f')
+
+
+def write_checkpoint(model_dir, tensors):
+    """Save (name, array) pairs with tf.train.Saver, which needs TensorFlow"""
+    import tensorflow as tf
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        variables = {
+            name: tf.Variable(value, name=name)
+            for name, value in tensors
+        }
+        sess.run(tf.global_variables_initializer())
+        tf.train.Saver(variables).save(sess,
+                                       os.path.join(model_dir, 'model.ckpt'))
+
+
+def write_model(model_dir, hparams=TINY, vocabulary=None, seed=0,
+                checkpoint=False):
+    """
+    Write a model with random weights and the given n_ctx, n_embd, n_head
+    and n_layer to model_dir. vocabulary is the folder of a model whose
+    encoder to copy, by default the byte vocabulary is used. With
+    checkpoint, a tf checkpoint with the same weights is written too.
+    """
+    os.makedirs(model_dir, exist_ok=True)
+    if vocabulary is None:
+        byte_vocabulary(model_dir)
+    else:
+        for name in ['encoder.json', 'vocab.bpe']:
+            shutil.copy(os.path.join(vocabulary, name), model_dir)
+    hparams = dict(hparams)
+    with open(os.path.join(model_dir, 'encoder.json')) as f:
+        hparams['n_vocab'] = len(json.load(f))
+    with open(os.path.join(model_dir, 'hparams.json'), 'w') as f:
+        json.dump(hparams, f)
+
+    def tensors():
+        rng = np.random.RandomState(seed)
+        for name, value in random_tensors(hparams, rng):
+            yield name, value.astype(np.float32)
+
+    convert.write_weights(model_dir, tensors())
+    if checkpoint:
+        write_checkpoint(model_dir, tensors())
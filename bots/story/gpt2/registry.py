@@ -0,0 +1,213 @@
+"""Models loaded on demand within a memory budget
+
+A Registry hands out the generator of any model, loading it on first use
+with the same backend and options for all models. The weights of all
+loaded models stay within the budget: before another model is loaded, the
+least recently used ones are evicted, except those still in use. Before a
+model is evicted, its weights are written in the format that loads fastest
+(see Generator.save_weights), so that asking for it again maps them rather
+than reading the checkpoint.
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import threading
+import collections
+
+import memory
+import generate_text
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+class Registry:
+    """
+    :budget=None : Integer, bytes the weights of all loaded models may use,
+     defaults to a share of the memory available when loading
+    :backend=tf : String, generation backend (see generate_text.py)
+    :models_dir : path to parent folder containing model subfolders
+    :options : other arguments of generate_text.get_generator
+    """
+
+    def __init__(
+            self,
+            budget=None,
+            backend='tf',
+            models_dir=os.path.join(DIR, 'models'),
+            **options
+    ):
+        self.budget = budget
+        self.backend = backend
+        self.models_dir = os.path.expanduser(os.path.expandvars(models_dir))
+        self.options = options
+        # loaded generators, least recently used first
+        self.generators = collections.OrderedDict()
+        # bytes reserved by models being loaded or evicted outside the lock
+        self.pending = {}
+        self.users = collections.Counter()
+        self.history = {}
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def weight_bytes(self, model_name):
+        """Estimated memory of the weights of model_name before loading it"""
+        total = 0
+        for name in [model_name, self.options.get('draft_model')]:
+            if name:
+                with open(os.path.join(self.models_dir, name,
+                                       'hparams.json')) as f:
+                    hparams = types.SimpleNamespace(**json.load(f))
+                total += memory.weight_bytes(
+                    hparams, self.options.get('precision', 'float32'))
+        return total
+
+    def resident_bytes(self):
+        return sum(g.weight_bytes()
+                   for g in self.generators.values()) + sum(
+                       self.pending.values())
+
+    def acquire(self, model_name):
+        """
+        Return the generator of model_name, loading it if needed, and keep
+        it loaded until released. Raises MemoryError if it doesn't fit the
+        budget next to the models in use. Models are loaded and evicted
+        outside the lock, so that other requests aren't held up; requests
+        for a model that is being loaded or evicted wait for it.
+        """
+        with self.lock:
+            while model_name in self.pending:
+                self.changed.wait()
+            if model_name in self.generators:
+                self.generators.move_to_end(model_name)
+                self.users[model_name] += 1
+                return self.generators[model_name]
+
+            needed = self.weight_bytes(model_name)
+            budget = self.budget
+            if budget is None:
+                budget = self.resident_bytes() + int(
+                    memory.available_bytes() * memory.SAFETY_FRACTION)
+            # the memory of models evicted here is free once this thread
+            # has unloaded them, before it loads model_name
+            evicted = []
+            freed = 0
+            for name in list(self.generators):
+                if self.resident_bytes() - freed + needed <= budget:
+                    break
+                if not self.users[name]:
+                    evicted.append(self.evict(name))
+                    freed += self.pending[name]
+            if self.resident_bytes() - freed + needed > budget:
+                self.restore(evicted)
+                raise MemoryError(
+                    'Loading {} needs {} MB, but only {} of {} MB are '
+                    'free'.format(model_name, needed // 2**20,
+                                  (budget - self.resident_bytes()) // 2**20,
+                                  budget // 2**20))
+            self.pending[model_name] = needed
+
+        try:
+            for name, generator in evicted:
+                self.unload(name, generator)
+            start = time.time()
+            generator = generate_text.get_generator(
+                self.backend,
+                model_name=model_name,
+                models_dir=self.models_dir,
+                **self.options,
+            )
+        except BaseException:
+            with self.lock:
+                del self.pending[model_name]
+                self.restore([(name, generator)
+                              for name, generator in evicted
+                              if name in self.pending])
+                self.changed.notify_all()
+            raise
+
+        with self.lock:
+            del self.pending[model_name]
+            history = self.history.setdefault(model_name, {
+                'loads': 0,
+                'evictions': 0,
+            })
+            history['loads'] += 1
+            history['load_seconds'] = time.time() - start
+            history['weight_format'] = generator.weight_format()
+            self.generators[model_name] = generator
+            self.users[model_name] += 1
+            self.changed.notify_all()
+        print('Loaded {} from {} in {:.2f}s'.format(
+            model_name, history['weight_format'], history['load_seconds']),
+              file=sys.stderr)
+        return generator
+
+    def release(self, generator):
+        """Let a generator from acquire be evicted again"""
+        with self.lock:
+            self.users[generator.model_name] -= 1
+
+    def evict(self, model_name):
+        """
+        Take model_name out of the loaded models, holding on to its memory
+        until unload. Call with the lock held.
+        """
+        generator = self.generators.pop(model_name)
+        self.pending[model_name] = generator.weight_bytes()
+        return model_name, generator
+
+    def restore(self, evicted):
+        """Undo evict for models that weren't unloaded yet"""
+        for name, generator in reversed(evicted):
+            del self.pending[name]
+            self.generators[name] = generator
+            self.generators.move_to_end(name, last=False)
+
+    def unload(self, model_name, generator):
+        """Save and close an evicted generator, outside the lock"""
+        try:
+            try:
+                generator.save_weights()
+            except OSError as e:
+                print('Could not save the weights of {}: {}'.format(
+                    model_name, e),
+                      file=sys.stderr)
+            generator.close()
+        finally:
+            with self.lock:
+                del self.pending[model_name]
+                self.history[model_name]['evictions'] += 1
+                self.evictions += 1
+                self.changed.notify_all()
+        print('Evicted {}'.format(model_name), file=sys.stderr)
+
+    def stats(self):
+        """
+        The budget, the options models are loaded with, the loaded models
+        with their memory and the history of every model ever loaded
+        """
+        with self.lock:
+            return {
+                'budget': self.budget,
+                'options': dict(self.options, backend=self.backend),
+                'resident_bytes': self.resident_bytes(),
+                'resident': [{
+                    'model_name': name,
+                    'weight_bytes': generator.weight_bytes(),
+                    'in_use': self.users[name],
+                } for name, generator in reversed(self.generators.items())],
+                'pending': sorted(self.pending),
+                'models': self.history,
+                'loads': sum(h['loads'] for h in self.history.values()),
+                'evictions': self.evictions,
+            }
+
+    def close(self):
+        with self.lock:
+            for generator in self.generators.values():
+                generator.close()
+            self.generators.clear()
@@ -1,24 +1,23 @@
+import os
+import json
+import numpy as np
 import tensorflow as tf
 
 import model
+import memory
+import generator
 
 def top_k_logits(logits, k):
     if k == 0:
         # no truncation
         return logits
 
-    def _top_k():
-        values, _ = tf.nn.top_k(logits, k=k)
-        min_values = values[:, -1, tf.newaxis]
-        return tf.where(
-            logits < min_values,
-            tf.ones_like(logits, dtype=logits.dtype) * -1e10,
-            logits,
-        )
-    return tf.cond(
-       tf.equal(k, 0),
-       lambda: logits,
-       lambda: _top_k(),
+    values, _ = tf.nn.top_k(logits, k=k)
+    min_values = values[:, -1, tf.newaxis]
+    return tf.where(
+        logits < min_values,
+        tf.ones_like(logits, dtype=logits.dtype) * -1e10,
+        logits,
     )
 
 
@@ -32,7 +31,7 @@ def top_p_logits(logits, p):
         # number of indices to include
         tf.maximum(tf.reduce_sum(tf.cast(cumulative_probs <= p, tf.int32), axis=-1) - 1, 0),
     ], axis=-1)
-    min_values = tf.gather_nd(sorted_logits, indices)
+    min_values = tf.gather_nd(sorted_logits, indices)[:, tf.newaxis]
     return tf.where(
         logits < min_values,
         tf.ones_like(logits) * -1e10,
@@ -40,56 +39,296 @@ def top_p_logits(logits, p):
     )
 
 
-def sample_sequence(*, hparams, length, start_token=None, batch_size=None, context=None, temperature=1, top_k=0, top_p=1):
+def sample_logits(logits, *, top_k=0, top_p=1):
+    """Draw one token per row of logits, returned as [batch, 1].
+
+    With top_k set, a single tf.nn.top_k selects the candidates and nucleus filtering and
+    sampling only look at that slice. Nucleus filtering is skipped entirely when top_p >= 1.
+    """
+    if top_k == 0:
+        if top_p < 1:
+            logits = top_p_logits(logits, p=top_p)
+        return tf.multinomial(logits, num_samples=1, output_dtype=tf.int32)
+
+    values, indices = tf.nn.top_k(logits, k=top_k)
+    if top_p < 1:
+        # same cutoff as top_p_logits, but values are already sorted
+        cumulative_probs = tf.cumsum(tf.nn.softmax(values, axis=-1), axis=-1)
+        last = tf.maximum(tf.reduce_sum(tf.cast(cumulative_probs <= top_p, tf.int32), axis=-1) - 1, 0)
+        values = tf.where(
+            tf.range(top_k)[tf.newaxis, :] <= last[:, tf.newaxis],
+            values,
+            tf.ones_like(values) * -1e10,
+        )
+    choices = tf.multinomial(values, num_samples=1, output_dtype=tf.int32)
+    return tf.gather_nd(indices, tf.stack([tf.range(tf.shape(indices)[0]), choices[:, 0]], axis=-1))[:, tf.newaxis]
+
+
+def sample_sequence(*, hparams, length, start_token=None, batch_size=None, context=None, temperature=1, top_k=0, top_p=1,
+                    stop_tokens=None, sentence_ends=None, stop_sentences=0, min_length=0, cache=None):
+    """Sample up to length tokens after context.
+
+    Keys and values go into buffers preallocated for n_ctx positions (see model.cache_variables),
+    written in place at the current position, so each step costs the same regardless of how many
+    tokens came before. The context goes through model.prefill, which only projects its last
+    position onto the vocabulary, and every sample after that through model.decode. The cache
+    buffers are local variables: run tf.local_variables_initializer() once after building the
+    graph. Graphs of the same batch_size can share one set of buffers by passing the same cache,
+    as long as they don't run at the same time.
+
+    A row is done once it samples one of stop_tokens, or ends its stop_sentences-th sentence (per
+    the boolean sentence_ends table over the vocabulary) after at least min_length tokens. The loop
+    exits as soon as every row is done. Returns a dict of 'tokens' (context and samples),
+    'lengths' (samples per row up to its stop) and 'scores' (mean log-probability of those samples
+    under the model).
+    """
     if start_token is None:
         assert context is not None, 'Specify exactly one of start_token and context!'
     else:
         assert context is None, 'Specify exactly one of start_token and context!'
         context = tf.fill([batch_size, 1], start_token)
+    if batch_size is None:
+        batch_size = context.shape[0].value
+    assert batch_size is not None, 'The cache needs a static batch size'
 
-    def step(hparams, tokens, past=None):
-        lm_output = model.model(hparams=hparams, X=tokens, past=past, reuse=tf.AUTO_REUSE)
+    with tf.name_scope('sample_sequence'):
+        if cache is None:
+            cache = model.cache_variables(hparams=hparams, batch_size=batch_size)
+        context_length = tf.shape(context)[1]
 
-        logits = lm_output['logits'][:, :, :hparams.n_vocab]
-        presents = lm_output['present']
-        presents.set_shape(model.past_shape(hparams=hparams, batch_size=batch_size))
-        return {
-            'logits': logits,
-            'presents': presents,
-        }
+        def step(logits):
+            logits = logits[:, :hparams.n_vocab]
+            samples = sample_logits(logits / tf.to_float(temperature), top_k=top_k, top_p=top_p)
+            log_probs = tf.gather_nd(tf.nn.log_softmax(logits), tf.stack([tf.range(batch_size), samples[:, 0]], axis=-1))
+            return samples, log_probs
 
-    with tf.name_scope('sample_sequence'):
-        def body(past, prev, output):
-            next_outputs = step(hparams, prev, past=past)
-            logits = next_outputs['logits'][:, -1, :]  / tf.to_float(temperature)
-            logits = top_k_logits(logits, k=top_k)
-            logits = top_p_logits(logits, p=top_p)
-            samples = tf.multinomial(logits, num_samples=1, output_dtype=tf.int32)
-            return [
-                next_outputs['presents'] if past is None else tf.concat([past, next_outputs['presents']], axis=-2),
-                samples,
-                tf.concat([output, samples], axis=1)
-            ]
+        def track(i, samples, log_probs, done, sentences, lengths, total_log_probs):
+            # update the stop state of each row with the samples of step i
+            total_log_probs += tf.where(done, tf.zeros_like(log_probs), log_probs)
+            finished = tf.zeros([batch_size], dtype=tf.bool)
+            if stop_tokens is not None:
+                finished = tf.logical_or(finished, tf.gather(tf.constant(stop_tokens), samples[:, 0]))
+            if stop_sentences:
+                ends = tf.gather(tf.constant(sentence_ends), samples[:, 0])
+                sentences += tf.cast(ends, tf.int32)
+                finished = tf.logical_or(finished, tf.logical_and(
+                    ends, tf.logical_and(sentences >= stop_sentences, i + 1 >= min_length)))
+            lengths = tf.where(tf.logical_and(finished, tf.logical_not(done)), tf.fill([batch_size], i + 1), lengths)
+            return tf.logical_or(done, finished), sentences, lengths, total_log_probs
 
-        past, prev, output = body(None, context, context)
+        samples, log_probs = step(model.prefill(hparams=hparams, X=context, cache=cache, reuse=tf.AUTO_REUSE))
+        output = tf.TensorArray(tf.int32, size=0, dynamic_size=True, element_shape=[batch_size]).write(0, samples[:, 0])
+        done, sentences, lengths, total_log_probs = track(
+            tf.constant(0),
+            samples,
+            log_probs,
+            tf.zeros([batch_size], dtype=tf.bool),
+            tf.zeros([batch_size], dtype=tf.int32),
+            tf.fill([batch_size], length),
+            tf.zeros([batch_size]),
+        )
+
+        def body(i, prev, output, done, sentences, lengths, total_log_probs):
+            samples, log_probs = step(model.decode(
+                hparams=hparams, tokens=prev, cache=cache, cache_length=context_length + i - 1, reuse=tf.AUTO_REUSE))
+            return [i + 1, samples, output.write(i, samples[:, 0])] + list(
+                track(i, samples, log_probs, done, sentences, lengths, total_log_probs))
 
-        def cond(*args):
-            return True
+        def cond(i, prev, output, done, *args):
+            return tf.logical_and(i < length, tf.logical_not(tf.reduce_all(done)))
 
-        _, _, tokens = tf.while_loop(
+        _, _, output, _, _, lengths, total_log_probs = tf.while_loop(
             cond=cond, body=body,
-            maximum_iterations=length - 1,
             loop_vars=[
-                past,
-                prev,
-                output
+                tf.constant(1),
+                samples,
+                output,
+                done,
+                sentences,
+                lengths,
+                total_log_probs,
             ],
             shape_invariants=[
-                tf.TensorShape(model.past_shape(hparams=hparams, batch_size=batch_size)),
-                tf.TensorShape([batch_size, None]),
-                tf.TensorShape([batch_size, None]),
+                tf.TensorShape([]),
+                tf.TensorShape([batch_size, 1]),
+                tf.TensorShape(None),
+                tf.TensorShape([batch_size]),
+                tf.TensorShape([batch_size]),
+                tf.TensorShape([batch_size]),
+                tf.TensorShape([batch_size]),
             ],
             back_prop=False,
         )
 
-        return tokens
+        return {
+            'tokens': tf.concat([context, tf.transpose(output.stack())], axis=1),
+            'lengths': lengths,
+            'scores': total_log_probs / tf.to_float(tf.maximum(lengths, 1)),
+        }
+
+
+# SavedModel of sampling graphs in the model folder (see export.py)
+EXPORT_DIR = 'saved_model'
+EXPORT_INDEX = 'samplers.json'
+# bump when sample_sequence or model change the graphs they build
+EXPORT_VERSION = 3
+
+
+def sampler_key(batch_size, length, temperature, top_k, top_p, **stop):
+    """Settings that need a separate sampling graph"""
+    return (batch_size, length, float(temperature), top_k, float(top_p), tuple(sorted(stop)),
+            stop.get('stop_sentences'), stop.get('min_length'))
+
+
+def sampler_name(key):
+    """Signature name of an exported sampling graph"""
+    return json.dumps(key)
+
+
+class Generator(generator.Generator):
+    """TensorFlow backend. Sampling graphs are built once per distinct set of
+    (batch_size, length, temperature, top_k, top_p) and stop conditions, and
+    share the restored model variables. Graphs of the same batch_size also
+    share one set of key and value buffers, since they run one at a time, so
+    that more settings don't take more memory. Graphs exported by export.py
+    are loaded instead of built, as long as the export matches the seed and
+    is newer than the checkpoint."""
+
+    backend = 'tf'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.samplers = {}
+        # key and value buffers of the samplers, by batch_size
+        self.caches = {}
+
+        np.random.seed(self.seed)
+        self.sess = tf.Session(graph=tf.Graph())
+        with self.sess.graph.as_default():
+            tf.set_random_seed(self.seed)
+        self.saver = None
+        self.export_dir = os.path.join(self.model_dir, EXPORT_DIR)
+        self.exported = self.exported_samplers()
+        self.export_sess = None
+
+    def default_hparams(self):
+        return model.default_hparams()
+
+    def weight_format(self):
+        return 'saved_model' if self.exported else 'checkpoint'
+
+    def exported_samplers(self):
+        """Names of the usable exported sampling graphs"""
+        try:
+            with open(os.path.join(self.export_dir, EXPORT_INDEX)) as f:
+                index = json.load(f)
+            exported = os.path.getmtime(os.path.join(self.export_dir, EXPORT_INDEX))
+            checkpoint = tf.train.latest_checkpoint(self.model_dir)
+            if checkpoint and os.path.getmtime(checkpoint + '.index') > exported:
+                return set()
+        except (OSError, ValueError):
+            return set()
+        if index['version'] != EXPORT_VERSION or index['seed'] != self.seed:
+            return set()
+        return set(index['samplers'])
+
+    def load_export(self):
+        """Load the exported graphs and their variables, skipping graph construction"""
+        self.export_sess = tf.Session(graph=tf.Graph())
+        meta_graph = tf.saved_model.loader.load(
+            self.export_sess,
+            [tf.saved_model.tag_constants.SERVING],
+            self.export_dir,
+        )
+        graph = self.export_sess.graph
+        for name in self.exported:
+            signature = meta_graph.signature_def[name]
+            key = tuple(
+                tuple(x) if isinstance(x, list) else x for x in json.loads(name))
+            self.samplers[key] = (
+                self.export_sess,
+                graph.get_tensor_by_name(signature.inputs['context'].name),
+                {
+                    output: graph.get_tensor_by_name(tensor.name)
+                    for output, tensor in signature.outputs.items()
+                },
+            )
+
+    def generation_bytes(self, batch_size, context_length, length):
+        total = super().generation_bytes(batch_size, context_length, length)
+        if self.saver is None and self.export_sess is None:
+            # the weights are only restored with the first sampler
+            total += memory.weight_bytes(self.hparams)
+        # the buffers of other batch sizes stay allocated next to these
+        total += sum(memory.cache_bytes(self.hparams, size)
+                     for size in self.caches if size != batch_size)
+        return total
+
+    def sampler(self, batch_size, length, temperature, top_k, top_p, **stop):
+        """Return the session, context placeholder and outputs of a sampling graph"""
+        key = sampler_key(batch_size, length, temperature, top_k, top_p, **stop)
+        if sampler_name(key) in self.exported and self.export_sess is None:
+            self.load_export()
+        if key not in self.samplers:
+            with self.sess.graph.as_default():
+                cache = self.caches.get(batch_size)
+                if cache is None:
+                    cache = model.cache_variables(hparams=self.hparams, batch_size=batch_size)
+                    self.caches[batch_size] = cache
+                context = tf.placeholder(tf.int32, [batch_size, None])
+                output = sample_sequence(
+                    hparams=self.hparams,
+                    length=length,
+                    context=context,
+                    batch_size=batch_size,
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                    cache=cache,
+                    **stop)
+
+                # variables only exist after the first sampler is built
+                if self.saver is None:
+                    self.saver = tf.train.Saver()
+                    self.saver.restore(
+                        self.sess,
+                        tf.train.latest_checkpoint(self.model_dir),
+                    )
+                self.sess.run(tf.local_variables_initializer())
+
+            self.samplers[key] = (self.sess, context, output)
+        return self.samplers[key]
+
+    def sample(
+            self,
+            context_tokens,
+            batch_size,
+            length,
+            temperature,
+            top_k,
+            top_p,
+            **stop
+    ):
+        sess, context, output = self.sampler(
+            batch_size,
+            length,
+            temperature,
+            top_k,
+            top_p,
+            **stop
+        )
+        try:
+            out = sess.run(
+                output,
+                feed_dict={
+                    context: [context_tokens for _ in range(batch_size)]
+                })
+        except tf.errors.ResourceExhaustedError as e:
+            raise MemoryError(e.message) from e
+        out['tokens'] = out['tokens'][:, len(context_tokens):]
+        return out
+
+    def close(self):
+        self.sess.close()
+        if self.export_sess is not None:
+            self.export_sess.close()
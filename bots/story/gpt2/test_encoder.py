@@ -0,0 +1,159 @@
+import time
+import random
+import threading
+import collections
+
+import pytest
+import regex as re
+
+import encoder
+import bench_encoder
+import random_model
+
+
+@pytest.fixture(scope='module')
+def enc(tmp_path_factory):
+    model_dir = tmp_path_factory.mktemp('models') / 'bytes'
+    model_dir.mkdir()
+    random_model.byte_vocabulary(str(model_dir))
+    return encoder.get_encoder('bytes', str(model_dir.parent))
+
+
+def test_batch_round_trip(enc):
+    texts = ['Once upon a time,', '', 'Über\n\nnaïve  café ☕', '!!']
+    batch, pads = enc.encode_batch(texts)
+    assert batch.shape == (len(texts), max(len(enc.encode(t)) for t in texts))
+    # padded on the left, as np_model.model expects
+    assert [len(enc.encode(t)) + pad for t, pad in zip(texts, pads)
+            ] == [batch.shape[1]] * len(texts)
+    assert enc.decode_batch(batch, pads) == texts
+
+
+def test_decode_batch_lengths(enc):
+    batch, pads = enc.encode_batch(['abc', 'defgh'])
+    assert enc.decode_batch(batch, pads, lengths=[1, 2]) == ['a', 'de']
+
+
+def generate_corpus(rng, words=3000):
+    """Text of random words, unicode, whitespace runs and long words"""
+    alphabets = [
+        'etaoinshrdlu', 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ',
+        '0123456789', '.,;:!?\'"()-', 'éèüößñçå', 'αβγδεжзий', '中文字語言',
+        '🙂🐍☕✨'
+    ]
+    separators = [' ', ' ', ' ', '  ', '\n', '\n\n', '\n\n\n', '\t', ' \n ']
+    parts = []
+    for _ in range(words):
+        kind = rng.random()
+        if kind < 0.05:
+            # long words, repeating to stress merges of equal rank
+            part = rng.choice('ab') * rng.randint(50, 300)
+            if rng.random() < 0.5:
+                part = 'ab' * rng.randint(25, 150)
+        else:
+            alphabet = rng.choice(alphabets[:2] if kind < 0.7 else alphabets)
+            part = ''.join(
+                rng.choice(alphabet) for _ in range(rng.randint(1, 12)))
+        parts.append(part + rng.choice(separators))
+    return ''.join(parts)
+
+
+def train_merges(words, count):
+    """Merges in rank order of a naive BPE over words of byte symbols"""
+    vocab = collections.Counter(tuple(word) for word in words)
+    merges = []
+    for _ in range(count):
+        pairs = collections.Counter()
+        for word, n in vocab.items():
+            for pair in zip(word, word[1:]):
+                pairs[pair] += n
+        if not pairs:
+            break
+        best = max(pairs, key=lambda pair: (pairs[pair], pair))
+        merges.append(best)
+        merged = collections.Counter()
+        for word, n in vocab.items():
+            symbols = []
+            i = 0
+            while i < len(word):
+                if word[i:i + 2] == best:
+                    symbols.append(best[0] + best[1])
+                    i += 2
+                else:
+                    symbols.append(word[i])
+                    i += 1
+            merged[tuple(symbols)] += n
+        vocab = merged
+    return merges
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    return generate_corpus(random.Random(0))
+
+
+@pytest.fixture(scope='module')
+def merged_encoder(corpus):
+    """Encoder with merges learned from the corpus"""
+    byte_encoder = encoder.bytes_to_unicode()
+    pat = encoder.Encoder({}, []).pat
+    words = [
+        ''.join(byte_encoder[b] for b in token.encode('utf-8'))
+        for token in re.findall(pat, corpus)
+    ]
+    merges = train_merges(words, 400)
+    tokens = list(byte_encoder.values()) + [a + b for a, b in merges]
+    return lambda **kwargs: encoder.Encoder(
+        dict(zip(tokens, range(len(tokens)))), merges, **kwargs)
+
+
+def test_bpe_matches_reference(corpus, merged_encoder):
+    enc = merged_encoder(cache_size=0)
+    words = set(
+        ''.join(enc.byte_encoder[b] for b in token.encode('utf-8'))
+        for token in re.findall(enc.pat, corpus))
+    assert any(len(word) > 100 for word in words)
+    for word in words:
+        assert enc.bpe(word) == bench_encoder.reference_bpe(
+            enc.bpe_ranks, word), word
+    assert enc.decode(enc.encode(corpus)) == corpus
+
+
+class YieldingCache(collections.OrderedDict):
+
+    def get(self, key, default=None):
+        value = super().get(key, default)
+        time.sleep(0)
+        return value
+
+
+def test_bpe_cache_under_threads(corpus, merged_encoder):
+    rng = random.Random(1)
+    words = corpus.split()
+    texts = [' '.join(rng.sample(words, 100)) for _ in range(30)]
+    expected = [merged_encoder().encode(text) for text in texts]
+    # a small cache keeps evicting words that other threads look up, and
+    # lookups let them run before the word is moved to the end
+    enc = merged_encoder(cache_size=64)
+    enc.cache = YieldingCache()
+    errors = []
+
+    def encode(seed):
+        order = list(range(len(texts)))
+        random.Random(seed).shuffle(order)
+        try:
+            for i in order * 2:
+                if enc.encode(texts[i]) != expected[i]:
+                    errors.append('Mismatch for {!r}'.format(texts[i]))
+        except Exception as e:
+            errors.append(repr(e))
+
+    threads = [
+        threading.Thread(target=encode, args=(seed, )) for seed in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert enc.cache_hits and len(enc.cache) <= 64
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pytest
+
+import convert
+import np_model
+import quantize
+import random_model
+
+
+@pytest.mark.parametrize('precision', ['float16', 'int8'])
+@pytest.mark.parametrize('name,transpose', [('model/h0/mlp/c_fc/w', False),
+                                            ('model/wte', True)])
+def test_matmul_chunks(precision, name, transpose):
+    rng = np.random.RandomState(0)
+    # a conv1d matrix is [1, nx, nf], wte is [n_vocab, n_embd]
+    w = rng.randn(*((1, 16, 50) if name.endswith('/w') else (50, 16)))
+    params = dict(quantize.quantize([(name, w.astype(np.float32))],
+                                    precision))
+    x = rng.randn(3, 16).astype(np.float32)
+    expected = x @ (w.reshape(w.shape[-2:]).T if transpose else w[0])
+    # output channels in several chunks, the last one partial
+    out = quantize.matmul(x, params, name, transpose, chunk_size=16)
+    assert np.allclose(out, expected, atol=0.1)
+    assert np.array_equal(
+        out, quantize.matmul(x, params, name, transpose, chunk_size=64))
+
+
+def test_load_params_converts_once(tmp_path, monkeypatch):
+    model_dir = str(tmp_path / 'tiny')
+    # float32 weights only, without a checkpoint to read
+    random_model.write_model(model_dir)
+    expected = convert.load_weights(model_dir)
+    params = np_model.load_params(model_dir, 'int8')
+    assert convert.has_weights(model_dir, 'int8')
+    assert not params['model/wte'].flags.writeable
+    assert params['model/h0/attn/c_attn/w:scale'].ndim == 1
+
+    def no_conversion(*args):
+        raise AssertionError('Converted again')
+
+    # the next load maps the converted weights
+    monkeypatch.setattr(convert, 'source_tensors', no_conversion)
+    again = np_model.load_params(model_dir, 'int8')
+    assert sorted(again) == sorted(params)
+    assert np.array_equal(
+        quantize.dequantize(again, 'model/wte'),
+        quantize.dequantize(dict(quantize.quantize(expected.items(), 'int8')),
+                            'model/wte'))
+    assert not [name for name in os.listdir(model_dir) if '.tmp' in name]
@@ -0,0 +1,78 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import convert
+import registry
+import random_model
+
+
+@pytest.fixture
+def models_dir(tmp_path):
+    for name in ['a', 'b']:
+        random_model.write_model(str(tmp_path / name))
+    return str(tmp_path)
+
+
+def test_load_outside_lock(models_dir, monkeypatch):
+    models = registry.Registry(backend='numpy', models_dir=models_dir)
+    a = models.acquire('a')
+
+    loading = threading.Event()
+    proceed = threading.Event()
+    get_generator = registry.generate_text.get_generator
+
+    def slow_get_generator(*args, **kwargs):
+        loading.set()
+        assert proceed.wait(30)
+        return get_generator(*args, **kwargs)
+
+    monkeypatch.setattr(registry.generate_text, 'get_generator',
+                        slow_get_generator)
+    thread = threading.Thread(target=models.acquire, args=('b', ))
+    thread.start()
+    try:
+        assert loading.wait(30)
+        # none of these wait for the load of b
+        assert models.stats()['pending'] == ['b']
+        models.release(a)
+        assert models.acquire('a') is a
+        models.release(a)
+    finally:
+        proceed.set()
+        thread.join()
+    assert [m['model_name'] for m in models.stats()['resident']] == ['b', 'a']
+    models.close()
+
+
+def test_evict_to_fit_budget(models_dir):
+    weights = registry.Registry(models_dir=models_dir).weight_bytes('a')
+    # room for one of the models at a time
+    models = registry.Registry(budget=weights * 3 // 2,
+                               backend='numpy',
+                               models_dir=models_dir)
+    models.release(models.acquire('a'))
+    b = models.acquire('b')
+    stats = models.stats()
+    assert [m['model_name'] for m in stats['resident']] == ['b']
+    assert stats['evictions'] == 1 and not stats['pending']
+    with pytest.raises(MemoryError):
+        models.acquire('a')
+    models.release(b)
+    models.close()
+
+
+def test_interrupted_write_keeps_weights(models_dir):
+    model_dir = os.path.join(models_dir, 'a')
+    before = convert.load_weights(model_dir)['model/wte'].copy()
+
+    def tensors():
+        yield 'model/wte', np.zeros_like(before)
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        convert.write_weights(model_dir, tensors())
+    assert np.array_equal(convert.load_weights(model_dir)['model/wte'], before)
+    assert not [name for name in os.listdir(model_dir) if '.tmp' in name]
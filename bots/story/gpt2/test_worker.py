@@ -0,0 +1,53 @@
+import queue
+import threading
+
+import pytest
+
+import worker
+import random_model
+from registry import Registry
+
+
+@pytest.fixture(scope='module')
+def registry(tmp_path_factory):
+    models_dir = tmp_path_factory.mktemp('models')
+    # byte vocabulary: one token per character, n_ctx 512
+    random_model.write_model(str(models_dir / 'tiny'))
+    registry = Registry(backend='numpy',
+                        models_dir=str(models_dir),
+                        seed=0,
+                        memory_budget=2**30)
+    yield registry
+    registry.close()
+
+
+def job(registry, **kwargs):
+    return worker.Job(registry.acquire('tiny'), dict(top_k=40, **kwargs))
+
+
+def test_batch_fits_window(registry):
+    w = worker.Worker(registry, 'tiny')
+    short = job(registry, raw_text='a' * 10, length=16)
+    other = job(registry, raw_text='b' * 20, length=32)
+    assert w.fits([short], other)
+    for j in [short, other]:
+        registry.release(j.generator)
+
+
+def test_batch_of_different_shapes(registry):
+    w = worker.Worker(registry, 'tiny', batch_wait=0.5)
+    # each fits the window alone, but not padded to 400 + 300 tokens
+    long_context = job(registry, raw_text='a' * 400, length=16)
+    long_length = job(registry, raw_text='b' * 10, length=300)
+    assert not w.fits([long_context], long_length)
+
+    w.jobs.put(long_context)
+    w.jobs.put(long_length)
+    threading.Thread(target=w.decode, daemon=True).start()
+    for j in [long_context, long_length]:
+        try:
+            response = j.responses.get(timeout=60)
+        except queue.Empty:
+            pytest.fail('No response')
+        assert 'error' not in response
+        assert len(response['candidates']) == 1
@@ -0,0 +1,385 @@
+"""Long-lived generation worker
+
+The worker loads the encoder and model once and keeps the session warm,
+answering generation requests over a Unix socket. Requests and responses
+are single lines of JSON:
+
+    -> {"raw_text": "Once upon a time,", "length": 128, "top_k": 40}
+    <- {"candidates": [{"text": "...", "score": -2.5}]}
+
+With "stream": true, the worker sends a {"rows": [...]} line after every
+token (see Generator.stream) before the final response, and stops decoding
+when the client closes the connection.
+
+Errors are reported as {"error": "..."} so that clients can fall back to
+running generate_text.py in a fresh process. Running out of memory also
+sets "out_of_memory", which request() raises as a MemoryError.
+
+Several clients can be served at once. Requests that arrive within
+batch_wait seconds of each other are decoded together in one padded batch
+(see Generator.stream_batch) if their sampling settings match, up to
+max_batch rows and the memory budget; each still ends at its own length
+and stop conditions. A request may name another "model_name", which is
+loaded on first use with the options of the worker, evicting the least
+recently used models if their weights would exceed models_budget (see
+registry.py). One worker at socket_path() can thus serve all stories of a
+host with a single copy of each model. {"stats": true} is answered with
+the options models are loaded with, which clients can compare with their
+own, and the statistics of the loaded models:
+
+    -> {"stats": true}
+    <- {"stats": {"options": {"backend": "numpy", ...}, "resident": [...],
+                  "loads": 3, "evictions": 1, ...}}
+"""
+
+import os
+import sys
+import json
+import time
+import fire
+import queue
+import signal
+import socket
+import threading
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def socket_path(model_name=None):
+    """Socket of the worker of model_name, or of the one shared by all"""
+    if model_name is None:
+        return os.path.join(DIR, 'models', 'worker.sock')
+    return os.path.join(DIR, 'models', model_name, 'worker.sock')
+
+
+def is_running(path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(path)
+        return True
+    except OSError:
+        return False
+
+
+def check(response):
+    if response.get('out_of_memory'):
+        raise MemoryError(response['error'])
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return response
+
+
+def request(path, raw_text, timeout=None, **kwargs):
+    """
+    Send one generation request to a running worker and return the list of
+    candidates, dicts with the 'text' and 'score' of each sample
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(path)
+        conn.sendall(
+            json.dumps(dict(raw_text=raw_text, **kwargs)).encode('utf-8') +
+            b'\n')
+        with conn.makefile('rb') as f:
+            line = f.readline()
+
+    if not line:
+        raise ConnectionError('Worker closed the connection')
+
+    return check(json.loads(line.decode('utf-8')))['candidates']
+
+
+def stats(path, timeout=None):
+    """Statistics of the models of a running worker, see Registry.stats"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(path)
+        conn.sendall(json.dumps({'stats': True}).encode('utf-8') + b'\n')
+        with conn.makefile('rb') as f:
+            line = f.readline()
+
+    if not line:
+        raise ConnectionError('Worker closed the connection')
+
+    return check(json.loads(line.decode('utf-8')))['stats']
+
+
+def stream(path, raw_text, timeout=None, **kwargs):
+    """
+    Generator over the rows a running worker sends after every token, see
+    Generator.stream. Closing it cancels the request.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(path)
+        conn.sendall(
+            json.dumps(dict(raw_text=raw_text, stream=True, **kwargs)).encode(
+                'utf-8') + b'\n')
+        with conn.makefile('rb') as f:
+            for line in f:
+                response = check(json.loads(line.decode('utf-8')))
+                if 'candidates' in response:
+                    return
+                yield response['rows']
+    raise ConnectionError('Worker closed the connection')
+
+
+def error_response(e):
+    if isinstance(e, MemoryError):
+        return {'error': 'MemoryError: {}'.format(e), 'out_of_memory': True}
+    return {'error': '{}: {}'.format(type(e).__name__, e)}
+
+
+class Job:
+    """
+    A request waiting to be decoded, with a queue of the responses for its
+    client. nsamples rows (default batch_size) are decoded in one batch.
+    """
+
+    STOP = {'stop_eos', 'stop_sentences', 'min_length'}
+
+    def __init__(self, generator, kwargs):
+        self.generator = generator
+        self.stream = kwargs.pop('stream', False)
+        batch_size = kwargs.pop('nsamples', kwargs.pop('batch_size', 1))
+        context_tokens, length = generator.prepare(kwargs.pop('raw_text'),
+                                                   batch_size,
+                                                   kwargs.pop('length', None))
+        self.settings = (
+            kwargs.pop('temperature', 1),
+            kwargs.pop('top_k', 0),
+            kwargs.pop('top_p', 1),
+        )
+        if set(kwargs) - self.STOP:
+            raise TypeError('Unexpected arguments: {}'.format(', '.join(
+                sorted(set(kwargs) - self.STOP))))
+        self.request = dict(kwargs,
+                            context_tokens=context_tokens,
+                            batch_size=batch_size,
+                            length=length)
+        self.responses = queue.Queue()
+        self.cancelled = False
+
+    def finish(self, rows):
+        self.responses.put({
+            'candidates': [{
+                'text': row['text'],
+                'score': row['score']
+            } for row in rows]
+        })
+
+
+class Worker:
+    """
+    The queue of jobs for the models of a Registry, which decode() works
+    off in batches. Requests without a model_name use model_name.
+    """
+
+    def __init__(self, registry, model_name, batch_wait=1, max_batch=16):
+        self.registry = registry
+        self.model_name = model_name
+        self.batch_wait = batch_wait
+        self.max_batch = max_batch
+        self.jobs = queue.Queue()
+        self.waiting = []
+
+    def handle(self, conn):
+        """Answer the request on conn once its job is decoded"""
+        job = None
+        try:
+            with conn, conn.makefile('rwb') as f:
+                line = f.readline()
+                if not line:
+                    return
+                generator = None
+                try:
+                    kwargs = json.loads(line.decode('utf-8'))
+                    if kwargs.get('stats'):
+                        response = {'stats': self.registry.stats()}
+                    else:
+                        generator = self.registry.acquire(
+                            kwargs.pop('model_name', None) or self.model_name)
+                        job = Job(generator, kwargs)
+                except Exception as e:
+                    if generator is not None:
+                        self.registry.release(generator)
+                    response = error_response(e)
+                if job is None:
+                    f.write(json.dumps(response).encode('utf-8') + b'\n')
+                    return
+                self.jobs.put(job)
+                while True:
+                    response = job.responses.get()
+                    f.write(json.dumps(response).encode('utf-8') + b'\n')
+                    f.flush()
+                    if 'rows' not in response:
+                        return
+        except OSError:
+            # the client went away, which cancels its rows
+            if job is not None:
+                job.cancelled = True
+
+    def fits(self, batch, job):
+        """
+        Whether job can join batch. Padded rows share the longest context
+        and the longest length, which must fit the window together.
+        """
+        first = batch[0]
+        if not (job.generator is first.generator and
+                job.settings == first.settings and first.generator.batching):
+            return False
+        requests = [j.request for j in batch + [job]]
+        rows = sum(r['batch_size'] for r in requests)
+        context_length = max(len(r['context_tokens']) for r in requests)
+        length = max(r['length'] for r in requests)
+        return (rows <= self.max_batch and
+                context_length + length <= first.generator.hparams.n_ctx and
+                first.generator.generation_bytes(
+                    rows, context_length, length) <= first.generator.budget())
+
+    def next_batch(self):
+        """
+        Wait for a job, and batch_wait seconds for others to join it. Jobs
+        that don't fit wait for the next batch.
+        """
+        if not self.waiting:
+            self.waiting.append(self.jobs.get())
+        deadline = time.time() + self.batch_wait
+        while True:
+            try:
+                self.waiting.append(
+                    self.jobs.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        batch = [self.waiting.pop(0)]
+        for job in list(self.waiting):
+            if self.fits(batch, job):
+                batch.append(job)
+                self.waiting.remove(job)
+        for job in batch:
+            if job.cancelled:
+                self.registry.release(job.generator)
+        return [job for job in batch if not job.cancelled]
+
+    def decode(self):
+        """Decode batches of jobs forever"""
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                continue
+            temperature, top_k, top_p = batch[0].settings
+            pending = set(batch)
+            try:
+                steps = batch[0].generator.stream_batch(
+                    [job.request for job in batch],
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                )
+                try:
+                    for rows in steps:
+                        for job, job_rows in zip(batch, rows):
+                            if job not in pending:
+                                continue
+                            if job.cancelled:
+                                pending.remove(job)
+                                continue
+                            if job.stream:
+                                job.responses.put({'rows': job_rows})
+                            if all(row['done'] for row in job_rows):
+                                job.finish(job_rows)
+                                pending.remove(job)
+                        if not pending:
+                            break
+                finally:
+                    steps.close()
+            except Exception as e:
+                for job in pending:
+                    job.responses.put(error_response(e))
+            finally:
+                for job in batch:
+                    self.registry.release(job.generator)
+
+
+def serve(
+        model_name='124M',
+        path=None,
+        seed=None,
+        models_dir=os.path.join(DIR, 'models'),
+        backend='tf',
+        precision='float32',
+        prefix_cache=False,
+        draft_model=None,
+        draft_length=4,
+        memory_budget=None,
+        sliding_window=False,
+        retain_prefix=0,
+        batch_wait=1,
+        max_batch=16,
+        models_budget=None,
+):
+    """
+    Run the worker until interrupted
+    :model_name=124M : String, which model to load, and to use for requests
+     that don't name one
+    :path=None : Socket path, defaults to worker.sock in the model folder
+    :seed=None : Integer seed for random number generators
+    :models_dir : path to parent folder containing model subfolders
+    :backend=tf : String, generation backend (see generate_text.py)
+    :precision=float32 : String, weight precision for the numpy backend
+    :prefix_cache=False : Boolean, reuse saved keys and values of contexts
+    :draft_model=None : String, smaller model for speculative decoding
+    :draft_length=4 : Integer, tokens drafted per verification
+    :memory_budget=None : Integer, bytes a batch may use on top of the
+     weights, defaults to a share of the memory available at the time
+    :sliding_window=False : Boolean, allow samples longer than the window
+    :retain_prefix=0 : Integer, context tokens kept when the window slides
+    :batch_wait=1 : Float, seconds to wait for more requests to batch with
+    :max_batch=16 : Integer, most rows decoded together
+    :models_budget=None : Integer, bytes the weights of all loaded models
+     may use, defaults to a share of the memory available at each load
+    """
+    from registry import Registry
+
+    if path is None:
+        path = socket_path(model_name)
+
+    registry = Registry(
+        budget=models_budget,
+        backend=backend,
+        models_dir=models_dir,
+        precision=precision,
+        prefix_cache=prefix_cache,
+        draft_model=draft_model,
+        draft_length=draft_length,
+        seed=seed,
+        memory_budget=memory_budget,
+        sliding_window=sliding_window,
+        retain_prefix=retain_prefix,
+    )
+    registry.release(registry.acquire(model_name))
+    worker = Worker(registry, model_name, batch_wait, max_batch)
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    # clean up the socket when stopped by a service manager
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    threading.Thread(target=worker.decode, daemon=True).start()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(path)
+        server.listen()
+        try:
+            while True:
+                conn, _ = server.accept()
+                threading.Thread(target=worker.handle,
+                                 args=(conn, ),
+                                 daemon=True).start()
+        finally:
+            registry.close()
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    fire.Fire(serve)
@@ -0,0 +1,87 @@
+import os
+import sys
+import json
+
+from bots.story import bot
+
+sys.path.insert(0, os.path.join(bot.DIR, 'gpt2'))
+
+import encoder
+import np_sample
+import random_model
+
+
+def write_model(models_dir):
+    """A tiny random model whose vocabulary merges '\n\n' like GPT-2's"""
+    vocabulary = os.path.join(models_dir, 'vocabulary')
+    os.makedirs(vocabulary)
+    random_model.byte_vocabulary(vocabulary)
+    newline = encoder.bytes_to_unicode()[ord('\n')]
+    with open(os.path.join(vocabulary, 'encoder.json')) as f:
+        tokens = json.load(f)
+    tokens[newline * 2] = len(tokens)
+    with open(os.path.join(vocabulary, 'encoder.json'), 'w') as f:
+        json.dump(tokens, f)
+    with open(os.path.join(vocabulary, 'vocab.bpe'), 'a',
+              encoding='utf-8') as f:
+        f.write('{0} {0}\n'.format(newline))
+    random_model.write_model(os.path.join(models_dir, 'tiny'),
+                             vocabulary=vocabulary)
+
+
+def story_bot(tmp_path, enc, prefix_cache):
+    story = bot.StoryBot.__new__(bot.StoryBot)
+    story.encoder = enc
+    story.prefix_cache = prefix_cache
+    story.index = bot.StoryIndex(str(tmp_path / 'index.json'))
+    return story
+
+
+def add_entry(story, number):
+    text = 'Entry {} of the story, which goes on.'.format(number)
+    story.index.entries.append({
+        'page': 1,
+        'entry': number,
+        'text': text,
+        'token_count': len(story.encoder.encode(text + '\n\n')),
+    })
+
+
+def test_build_context_length(tmp_path):
+    write_model(str(tmp_path))
+    enc = encoder.get_encoder('tiny', str(tmp_path))
+    for prefix_cache in [False, True]:
+        story = story_bot(tmp_path, enc, prefix_cache)
+        lengths = []
+        for number in range(20):
+            add_entry(story, number)
+            lengths.append(len(enc.encode(story.build_context(200))))
+        if prefix_cache:
+            # whole entries, trimmed in coarse steps
+            assert max(lengths) <= 200
+            assert min(lengths[5:]) < 200 * bot.CONTEXT_KEEP_FRACTION + 50
+        else:
+            # once the story is long enough, always exactly context_length
+            assert lengths[5:] == [200] * 15
+
+
+def test_build_context_hits_prefix_cache(tmp_path):
+    write_model(str(tmp_path))
+    generator = np_sample.Generator(model_name='tiny',
+                                    models_dir=str(tmp_path),
+                                    prefix_cache=True,
+                                    seed=0)
+    story = story_bot(tmp_path, generator.enc, True)
+
+    # enough entries that old ones were dropped already
+    for number in range(6):
+        add_entry(story, number)
+    first = story.build_context(200)
+    assert not first.startswith('Entry 0 ')
+    generator.sample(generator.enc.encode(first), 1, 8, 1, 0, 1)
+
+    add_entry(story, 6)
+    second = story.build_context(200)
+    assert second.startswith(first)
+    out = generator.sample(generator.enc.encode(second), 1, 8, 1, 0, 1)
+    assert out['prefix_length'] == len(generator.enc.encode(first)) - 1